@@ -0,0 +1,281 @@
+# Benchmark of export_node_metrics.py against a local stub prometheus
+# Author: Marc Methot
+#
+# Usage: python export_node_metrics_bench.py [--metrics 300] [--series 16] [--latency 0.05]
+#                                            [--jobs 16] [--nodes 10] [--days 1] [--range-metrics 10]
+#
+# StubPrometheus answers the label values and query APIs with synthetic node
+# metrics of --nodes instances after --latency seconds, like a busy prometheus
+# would, so no cluster is needed. Also usable as a stand-in to try the
+# exporter out:
+#   python export_node_metrics.py --prometheus-url http://127.0.0.1:PORT
+
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import export_node_metrics as exporter
+
+# instance="..." or instance=~"..." matcher of a query
+INSTANCE_MATCHER = re.compile(r'instance(=~|=)"((?:[^"\\]|\\.)*)"')
+
+class StubPrometheus(object):
+    """Threaded HTTP server answering like prometheus for metrics node_bench_<n>"""
+    def __init__(self, metrics, series, samples=30, latency=0.0,
+                 instances=('openshift-worker-1.example.com',)):
+        self.names = ['node_bench_{}'.format(i) for i in range(metrics)] + ['up', 'kube_pod_info']
+        self.instances = list(instances)
+        self.series = series
+        self.samples = samples
+        self.latency = latency
+        self.queries = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with stub.lock:
+                    stub.connections += 1
+
+            def do_GET(self, params=None):
+                url = urlparse(self.path)
+                params = params or parse_qs(url.query)
+                if url.path == '/api/v1/label/__name__/values':
+                    body = {'status': 'success', 'data': stub.names}
+                elif url.path == '/api/v1/label/instance/values':
+                    instances = stub.instances
+                    if 'match[]' in params:
+                        instances = stub.matching(params['match[]'][0])
+                    body = {'status': 'success', 'data': instances}
+                elif url.path == '/api/v1/query':
+                    time.sleep(stub.latency)
+                    with stub.lock:
+                        stub.queries += 1
+                    body = stub.query(params['query'][0])
+                elif url.path == '/api/v1/query_range':
+                    time.sleep(stub.latency)
+                    with stub.lock:
+                        stub.queries += 1
+                    start, end, step = (float(params[k][0]) for k in ('start', 'end', 'step'))
+                    if (end - start) / step + 1 > exporter.MAX_POINTS:
+                        self.send_error(400, 'exceeded maximum resolution of 11,000 points per timeseries')
+                        return
+                    body = stub.query(params['query'][0], start, end, step)
+                else:
+                    self.send_error(404)
+                    return
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.do_GET(parse_qs(self.rfile.read(length).decode('utf-8')))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def matching(self, query):
+        """Instances selected by the instance matcher of query"""
+        op, value = INSTANCE_MATCHER.search(query).groups()
+        value = re.sub(r'\\(.)', r'\1', value)
+        if op == '=':
+            return [i for i in self.instances if i == value]
+        return [i for i in self.instances if re.fullmatch(value, i)]
+
+    def query(self, query, start=None, end=None, step=None):
+        """Instant range vector query, or query_range when given start, end and step"""
+        name = query.partition('{')[0]
+        if start is None:
+            times = [1611662400 + 10 * i for i in range(self.samples)]
+        else:
+            times = [start + step * i for i in range(int((end - start) // step) + 1)]
+        result = []
+        for instance in self.matching(query):
+            for s in range(self.series):
+                result.append({
+                    'metric': {'__name__': name, 'instance': instance, 'job': 'node-exporter', 'cpu': str(s)},
+                    'values': [[t, str(float(s * t % 1000))] for t in times],
+                })
+        return {'status': 'success', 'data': {'resultType': 'matrix', 'result': result}}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def legacyExport(url, dataDir, host, timeRange):
+    """The original loop, one new connection and one blocking query per metric"""
+    names = requests.get('{0}/api/v1/label/__name__/values'.format(url), verify=False).json()['data']
+    for metricName in names:
+        if metricName[0:4] != 'node':
+            continue
+        response = requests.get('{0}/api/v1/query'.format(url), verify=False,
+                                params={'query': '{metric}{{instance="{host}"}}{t}'.format(
+                                    metric=metricName, host=host, t=timeRange)})
+        if response.status_code != 200:
+            continue
+        data = response.json()
+        if len(data['data']['result']) > 1:
+            with gzip.open(os.path.join(dataDir, '{}.json.gz'.format(metricName)), 'w') as f:
+                f.write((json.dumps(data) + "\n").encode('utf-8'))
+
+def concurrentExport(url, dataDirs, timeRange, jobs):
+    session = exporter.makeSession(None, jobs)
+    names = [m for m in exporter.GetMetricsNames(session, url) if m[0:4] == 'node']
+    # Leaving the per metric lines out of the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        exporter.exportMetrics(session, url, dataDirs, names, timeRange, jobs)
+
+def printRows(title, rows):
+    print(title)
+    print('{:<22}{:>9}{:>13}{:>8}{:>10}'.format('', 'queries', 'connections', 'files', 'seconds'))
+    for name, queries, connections, files, spent in rows:
+        print('{:<22}{:>9}{:>13}{:>8}{:>10.2f}'.format(name, queries, connections, files, spent))
+
+def nodeDirs(outputDir, nodes):
+    dataDirs = {}
+    for node in nodes:
+        dataDirs[node] = os.path.join(outputDir, node)
+        os.mkdir(dataDirs[node])
+    return dataDirs
+
+def countFiles(outputDir):
+    return sum(len(files) for _, _, files in os.walk(outputDir))
+
+def benchNodes(opts):
+    """Exporting --nodes nodes with one run each against a single multi node run"""
+    nodes = ['openshift-worker-{}.example.com'.format(i) for i in range(opts.nodes)]
+    rows = []
+    for name in ('one run per node', 'one multi node run'):
+        stub = StubPrometheus(opts.metrics, opts.series, latency=opts.latency, instances=nodes)
+        outputDir = tempfile.mkdtemp(prefix='export_bench_')
+        try:
+            started = time.perf_counter()
+            if name == 'one run per node':
+                for node in nodes:
+                    concurrentExport(stub.url, nodeDirs(outputDir, [node]), '[5m]', opts.jobs)
+            else:
+                concurrentExport(stub.url, nodeDirs(outputDir, nodes), '[5m]', opts.jobs)
+            spent = time.perf_counter() - started
+            rows.append((name, stub.queries, stub.connections, countFiles(outputDir), spent))
+        finally:
+            shutil.rmtree(outputDir)
+            stub.close()
+    printRows('{} node metrics of {} series on {} nodes, {:.0f}ms per query'.format(
+        opts.metrics, opts.series, opts.nodes, opts.latency * 1000), rows)
+
+def serveStub(conn, metrics, series, latency):
+    stub = StubPrometheus(metrics, series, latency=latency)
+    conn.send(stub.url)
+    conn.recv()
+    conn.send(stub.queries)
+
+def rangeExport(opts, chunk, traced):
+    """Runs exportRange against a stub in its own process, so that the peak memory is only the exporter's"""
+    host = 'openshift-worker-1.example.com'
+    end = 1611662400
+    conn, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serveStub, args=(child, opts.range_metrics, opts.series, opts.latency))
+    process.start()
+    url = conn.recv()
+    dataDir = tempfile.mkdtemp(prefix='export_bench_')
+    try:
+        session = exporter.makeSession(None, opts.jobs)
+        if traced:
+            tracemalloc.start()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            exported = exporter.exportRange(session, url, {host: dataDir},
+                                            ['node_bench_{}'.format(i) for i in range(opts.range_metrics)],
+                                            end - opts.days * 86400, end, 10, chunk, opts.jobs)[0]
+        spent = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] if traced else 0
+        tracemalloc.stop()
+        conn.send(None)
+        return conn.recv(), exported, peak, spent
+    finally:
+        shutil.rmtree(dataDir)
+        process.join()
+
+def benchRange(opts):
+    """query_range over --days of 10s points, whole range in one window per metric against time windows"""
+    rows = []
+    for name, chunk in (('one window per metric', opts.days * 86400), ('6h windows', 6 * 3600), ('1h windows', 3600)):
+        queries, exported, _, spent = rangeExport(opts, chunk, False)
+        peak = rangeExport(opts, chunk, True)[2]
+        rows.append((name, queries, exported, peak, spent))
+    print('{} node metrics of {} series over {} days at 10s, {:.0f}ms per query'.format(
+        opts.range_metrics, opts.series, opts.days, opts.latency * 1000))
+    print('{:<22}{:>9}{:>8}{:>10}{:>10}'.format('', 'queries', 'files', 'peak MB', 'seconds'))
+    for name, queries, exported, peak, spent in rows:
+        print('{:<22}{:>9}{:>8}{:>10.1f}{:>10.2f}'.format(name, queries, exported, peak / 1048576.0, spent))
+
+def main():
+    parser = argparse.ArgumentParser(description='export_node_metrics.py benchmark')
+    parser.add_argument('--metrics', type=int, default=300, help='node metrics served (default: 300)')
+    parser.add_argument('--series', type=int, default=16, help='Series per metric (default: 16)')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds per query (default: 0.05)')
+    parser.add_argument('--jobs', type=int, default=exporter.JOBS, help='Exporter jobs (default: %(default)s)')
+    parser.add_argument('--nodes', type=int, default=10, help='Nodes of the multi node benchmark (default: 10)')
+    parser.add_argument('--days', type=int, default=1,
+                        help='Days of 10s points in the range query benchmark (default: 1)')
+    parser.add_argument('--range-metrics', type=int, default=10,
+                        help='Metrics of the range query benchmark (default: 10)')
+    opts = parser.parse_args()
+
+    host = 'openshift-worker-1.example.com'
+    rows = []
+    for name in ('legacy loop', 'pooled, {} jobs'.format(opts.jobs)):
+        stub = StubPrometheus(opts.metrics, opts.series, latency=opts.latency)
+        dataDir = tempfile.mkdtemp(prefix='export_bench_')
+        try:
+            started = time.perf_counter()
+            if name == 'legacy loop':
+                legacyExport(stub.url, dataDir, host, '[5m]')
+            else:
+                concurrentExport(stub.url, {host: dataDir}, '[5m]', opts.jobs)
+            spent = time.perf_counter() - started
+            rows.append((name, stub.queries, stub.connections, len(os.listdir(dataDir)), spent))
+        finally:
+            shutil.rmtree(dataDir)
+            stub.close()
+
+    printRows('{} node metrics of {} series, {:.0f}ms per query'.format(
+        opts.metrics, opts.series, opts.latency * 1000), rows)
+    print('')
+    benchNodes(opts)
+    print('')
+    benchRange(opts)
+
+if __name__ == '__main__':
+    main()
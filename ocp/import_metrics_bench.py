@@ -0,0 +1,243 @@
+# Benchmarks for import_metrics_to_graphite.py on synthetic prometheus data
+# Author: Marc Methot
+#
+# Usage: python import_metrics_bench.py [--series 10000] [--samples 30] [--points 1000000]
+#                                       [--decode-samples 360]
+#
+# Senders are measured against FakeCarbon, a local TCP listener counting the
+# lines it receives, so no graphite is needed.
+
+import argparse
+import gzip
+import json
+import os
+import pickle
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import import_metrics_to_graphite as importer
+
+def syntheticResult(series, samples):
+    """node_cpu_seconds_total like matrix: one series per cpu and mode"""
+    modes = ['idle', 'iowait', 'irq', 'nice', 'softirq', 'steal', 'system', 'user']
+    result = []
+    for i in range(series):
+        result.append({
+            'metric': {
+                '__name__': 'node_cpu_seconds_total',
+                'instance': 'openshift-worker-1.example.com',
+                'job': 'node-exporter',
+                'cpu': str(i // len(modes)),
+                'mode': modes[i % len(modes)],
+            },
+            'values': [[1611662400 + 10 * s, str(float(i + s))] for s in range(samples)],
+        })
+    return result
+
+def legacyPaths(prefix, result):
+    """The original uniques block, every series ends up on uniques[0] (and
+    the original IndexError when no label pair is unique is turned into a
+    bare prefix)"""
+    uniques = []
+    for d in result:
+        for i in d['metric']:
+            uniques.append((i, d['metric'][i].replace('/', '_')))
+    entries = set(uniques)
+    for e in entries:
+        counter = uniques.count(e)
+        if counter > 1:
+            for i in range(counter):
+                uniques.remove(e)
+    if not uniques:
+        return [prefix for d in result]
+    return ['{}.{}.{}'.format(prefix, uniques[0][0], d['metric'][uniques[0][0]]) for d in result]
+
+def benchPaths(series, samples):
+    result = syntheticResult(series, samples)
+    rows = []
+    for name, func in (('legacy uniques', legacyPaths), ('seriesPaths', importer.seriesPaths)):
+        started = time.perf_counter()
+        paths = func('worker-1.node_cpu_seconds_total', result)
+        rows.append((name, time.perf_counter() - started, len(set(paths))))
+    print('Graphite paths for {} series'.format(series))
+    print('{:<18}{:>10}{:>16}'.format('', 'seconds', 'unique paths'))
+    for name, spent, unique in rows:
+        print('{:<18}{:>10.3f}{:>16}'.format(name, spent, unique))
+
+def legacyLoad(path):
+    """The original decoding, whole file decompressed then parsed at once"""
+    lines = gzip.open(path, 'r').readlines()
+    data = json.loads(lines[0])
+    return sum(len(d['values']) for d in data['data']['result'])
+
+def streamLoad(path):
+    """What produce() does, labels pass then values pass"""
+    labels = [d['metric'] for d in importer.iterSeries(path)]
+    return sum(len(d['values']) for d in importer.iterSeries(path)) if labels else 0
+
+def benchDecode(series, samples):
+    path = tempfile.mkstemp(suffix='.json.gz')[1]
+    try:
+        data = {'status': 'success', 'data': {'resultType': 'matrix',
+                                              'result': syntheticResult(series, samples)}}
+        with gzip.open(path, 'w') as f:
+            f.write((json.dumps(data) + '\n').encode('utf-8'))
+        del data
+        print('Decoding {} series of {} samples ({:.1f} MB gzipped)'.format(
+            series, samples, os.path.getsize(path) / 1048576.0))
+        print('{:<18}{:>10}{:>16}'.format('', 'seconds', 'peak MB'))
+        for name, load in (('legacy readlines', legacyLoad), ('iterSeries', streamLoad)):
+            started = time.perf_counter()
+            load(path)
+            spent = time.perf_counter() - started
+            tracemalloc.start()
+            load(path)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('{:<18}{:>10.2f}{:>16.1f}'.format(name, spent, peak / 1048576.0))
+    finally:
+        os.unlink(path)
+
+class FakeCarbon(object):
+    """Local TCP listener standing in for carbon, counts received points
+
+    Like carbon it parses every plaintext line, or unpickles every pickle
+    message, so both protocols pay their receiving cost.
+    """
+    def __init__(self, protocol='plaintext'):
+        self.protocol = protocol
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.lines = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        pending = b''
+        with conn:
+            while True:
+                data = conn.recv(1 << 20)
+                if not data:
+                    return
+                pending += data
+                if self.protocol == 'plaintext':
+                    lines = pending.split(b'\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        path, value, timestamp = line.split()
+                        float(value), int(timestamp)
+                    self.received(len(lines), len(data))
+                    continue
+                while len(pending) >= 4:
+                    size = struct.unpack('!L', pending[:4])[0]
+                    if len(pending) < 4 + size:
+                        break
+                    points = pickle.loads(pending[4:4 + size])
+                    pending = pending[4 + size:]
+                    self.received(len(points), 4 + size)
+
+    def received(self, points, size):
+        with self.lock:
+            self.lines += points
+            self.bytes += size
+
+    def wait(self, count, timeout=60):
+        deadline = time.time() + timeout
+        while self.lines < count and time.time() < deadline:
+            time.sleep(0.001)
+        return self.lines >= count
+
+    def close(self):
+        self.sock.close()
+
+def legacySend(port, message):
+    """Original sendMsg minus the print and the DELAY sleep after it"""
+    sock = socket.socket()
+    sock.connect(('127.0.0.1', port))
+    sock.sendall(bytearray(message, 'utf-8'))
+    sock.close()
+
+def printRates(title, rows):
+    print(title)
+    print('{:<26}{:>10}{:>10}{:>14}'.format('', 'points', 'seconds', 'points/s'))
+    for name, points, spent in rows:
+        print('{:<26}{:>10}{:>10.2f}{:>14.0f}'.format(name, points, spent, points / max(spent, 1e-9)))
+
+def timedSend(carbon, points, send):
+    before = carbon.lines
+    started = time.perf_counter()
+    send()
+    carbon.wait(before + points)
+    return time.perf_counter() - started
+
+def benchSender(points):
+    carbon = FakeCarbon()
+    path = 'worker-1.node_cpu_seconds_total.cpu.{}.mode.idle'
+    rows = []
+
+    # Connection per point, capped as it is orders of magnitude slower
+    legacyPoints = min(points, 2000)
+    spent = timedSend(carbon, legacyPoints, lambda: [
+        legacySend(carbon.port, '{} {} {}\n'.format(path.format(i % 64), i, 1611662400 + i))
+        for i in range(legacyPoints)])
+    rows.append(('socket per point', legacyPoints, spent))
+
+    def plaintext():
+        sender = importer.CarbonSender('127.0.0.1', carbon.port)
+        for i in range(points):
+            sender.send(path.format(i % 64), float(i), 1611662400 + i)
+        sender.flush()
+        sender.close()
+    rows.append(('CarbonSender plaintext', points, timedSend(carbon, points, plaintext)))
+    carbon.close()
+
+    carbon = FakeCarbon('pickle')
+    for batchSize in (500, 1000, 5000):
+        def pickled():
+            sender = importer.PickleSender('127.0.0.1', carbon.port, batchSize=batchSize)
+            for i in range(points):
+                sender.send(path.format(i % 64), float(i), 1611662400 + i)
+            sender.flush()
+            sender.close()
+        rows.append(('PickleSender batch {}'.format(batchSize), points, timedSend(carbon, points, pickled)))
+    carbon.close()
+    printRates('Carbon senders against a local fake carbon', rows)
+
+def main():
+    parser = argparse.ArgumentParser(description='import_metrics_to_graphite.py benchmarks')
+    parser.add_argument('--series', type=int, default=10000, help='Series in the synthetic result (default: 10000)')
+    parser.add_argument('--samples', type=int, default=30, help='Samples per series (default: 30)')
+    parser.add_argument('--points', type=int, default=1000000, help='Points sent to fake carbon (default: 1000000)')
+    parser.add_argument('--decode-samples', type=int, default=360,
+                        help='Samples per series for the decoding benchmark (default: 360)')
+    opts = parser.parse_args()
+    benchPaths(opts.series, opts.samples)
+    print('')
+    benchDecode(opts.series, opts.decode_samples)
+    print('')
+    benchSender(opts.points)
+
+if __name__ == '__main__':
+    main()
@@ -1,64 +1,632 @@
 # Script to read json files that were exported metrics from promotheus
 # Author: Marc Methot
 
+import argparse
+import collections
 import json
 import gzip
 import os
+import pickle
+import queue
 import socket
-from sys import argv
-from time import sleep
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# TODO: Have it check for more options
-if len(argv) != 2:
-    print("ERROR: Pass only the desired directory containing the compressed json files")
-    exit(2)
-elif not os.path.isdir(argv[1]):
-    print('ERROR: "{}" is not a directory or not the full path to it'.format(argv[1]))
-    exit(2)
-else:
-    dataDir = argv[1]
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import metrics_columnar
 
 
 # Your graphite configurations
 CARBON_SERVER = '127.0.0.1'
 CARBON_PORT = 2003
-DELAY = 0.01
-
-# TODO: Currently using plain text protocol, would be ideal to move to pickle
-#       for better performance with large datasets
-def sendMsg(message):
-    print('Sending message: %s' % message)
-    sock = socket.socket()
-    sock.connect((CARBON_SERVER, CARBON_PORT))
-    sock.sendall(bytearray(message, 'utf-8'))
-    sock.close()
-
-for f in os.listdir(dataDir):
-    if f[len(f)-8:] != '.json.gz':
-        continue
-    else:
-        lines = gzip.open('{rootDir}/{jsonFile}'.format(rootDir=dataDir, jsonFile=f), 'r').readlines()
-        # Note(mmethot): Assuming there will always only one line
-        data = json.loads(lines[0])
-
-
-# For graphite dot entries we'll want something unique
-uniques = []
-for d in data['data']['result']:
-    for i in d['metric']:
-        uniques.append((i, d['metric'][i].replace('/', '_')))
-
-entries = set(uniques)
-
-for e in entries:
-    counter = uniques.count(e)
-    if counter > 1:
-        for i in range(counter):
-            uniques.remove(e)
-
-serverName = dataDir[dataDir.find('_')+1:dataDir.rfind('_')].replace('.', '_')
-# TODO: Multithread this step otherwise it takes very long on large sets
-for d in data['data']['result']:
-    for v in d['values']:
-        sendMsg('{}.{}.{} {} {}\n'.format(serverName, uniques[0][0], d['metric'][uniques[0][0]], v[1], int(v[0])))
-        sleep(DELAY)
+CARBON_PICKLE_PORT = 2004
+# Points per pickle protocol message
+BATCH_SIZE = 500
+# Points per second sent to carbon, 0 for no limit
+RATE = 0
+# Bytes buffered before a write to the socket
+BUFFER_SIZE = 256 * 1024
+# Reconnection attempts before giving up on carbon
+RETRIES = 5
+# Metric files parsed in parallel and carbon connections sending them
+WORKERS = 4
+SENDERS = 2
+# Batches of up to QUEUE_BATCH points waiting for the senders
+QUEUE_SIZE = 64
+QUEUE_BATCH = 10000
+# Characters of decompressed json read at a time
+READ_SIZE = 1024 * 1024
+# Seconds between progress reports and checkpoint saves
+PROGRESS_INTERVAL = 5
+# Progress of the import, kept in the data directory unless --checkpoint is given
+CHECKPOINT_FILE = '.import_checkpoint.json'
+
+class CarbonSender(object):
+    """
+    Plaintext protocol sender keeping one connection to carbon open.
+
+    Lines are buffered and written with a single sendall once bufferSize is
+    reached, a failed write reconnects (with backoff) and resends the buffer.
+    rate paces the points per second instead of sleeping after each one.
+    """
+    def __init__(self, server=CARBON_SERVER, port=CARBON_PORT, rate=RATE,
+                 bufferSize=BUFFER_SIZE, retries=RETRIES):
+        self.server = server
+        self.port = port
+        self.rate = rate
+        self.bufferSize = bufferSize
+        self.retries = retries
+        self.sock = None
+        self.buffer = bytearray()
+        self.pending = 0
+        self.points = 0
+        self.started = None
+
+    def connect(self):
+        self.close()
+        self.sock = socket.create_connection((self.server, self.port), timeout=30)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.bufferSize)
+
+    def send(self, path, value, timestamp):
+        self.buffer += '{} {} {}\n'.format(path, value, int(timestamp)).encode('utf-8')
+        self.pending += 1
+        if len(self.buffer) >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.write(bytes(self.buffer))
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if self.started is None:
+            self.started = time.time()
+        self.throttle(self.pending)
+        for attempt in range(self.retries + 1):
+            try:
+                if self.sock is None:
+                    self.connect()
+                self.sock.sendall(data)
+                break
+            except (socket.error, socket.timeout) as e:
+                self.close()
+                if attempt == self.retries:
+                    raise
+                wait = min(2 ** attempt, 30)
+                print('WARNING: carbon {}:{} failed ({}), reconnecting in {}s'.format(
+                    self.server, self.port, e, wait))
+                time.sleep(wait)
+        self.points += self.pending
+        self.pending = 0
+
+    def throttle(self, count):
+        # Wait until sending count more points keeps us under rate
+        if not self.rate:
+            return
+        ahead = (self.points + count) / float(self.rate) - (time.time() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+
+class PickleSender(CarbonSender):
+    """
+    Pickle protocol sender, the format carbon prefers for large datasets.
+
+    Points are sent batchSize at a time as a pickled list of
+    (path, (timestamp, value)) tuples behind a 4 byte length header, the
+    connection handling and pacing are the ones of CarbonSender.
+    """
+    def __init__(self, server=CARBON_SERVER, port=CARBON_PICKLE_PORT, rate=RATE,
+                 batchSize=BATCH_SIZE, retries=RETRIES):
+        super(PickleSender, self).__init__(server, port, rate, BUFFER_SIZE, retries)
+        self.batchSize = batchSize
+        self.batch = []
+
+    def send(self, path, value, timestamp):
+        self.batch.append((path, (int(timestamp), float(value))))
+        self.pending += 1
+        if self.pending >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        # Protocol 2 so that carbon running on python 2 can still read it
+        payload = pickle.dumps(self.batch, protocol=2)
+        self.write(struct.pack('!L', len(payload)) + payload)
+        self.batch = []
+
+def sanitize(value):
+    # Dots would add levels to the graphite tree, slashes and spaces break it
+    return str(value).replace('/', '_').replace('.', '_').replace(' ', '_')
+
+def seriesPaths(prefix, result):
+    """Returns the graphite path of every series in a prometheus result, in order"""
+    return labelPaths(prefix, [d['metric'] for d in result])
+
+def labelPaths(prefix, labels):
+    """
+    Returns the graphite path of every series given their label dicts, in order.
+
+    Labels sharing one value across all series say nothing about a series, the
+    path is the prefix followed by key.value of every other label so that each
+    series gets its own path. Done in a single pass over the labels.
+    """
+    seen = {}
+    counts = {}
+    for metric in labels:
+        for key, value in metric.items():
+            seen.setdefault(key, set()).add(value)
+            counts[key] = counts.get(key, 0) + 1
+
+    # A label missing from some series also tells them apart
+    keys = sorted(k for k, values in seen.items()
+                  if k != '__name__' and (len(values) > 1 or counts[k] < len(labels)))
+    paths = []
+    for metric in labels:
+        parts = [prefix]
+        for key in keys:
+            parts.append(key)
+            parts.append(sanitize(metric.get(key, 'none')))
+        paths.append('.'.join(parts))
+    return paths
+
+def metricFiles(dataDir):
+    """Exported metric files, a .cols file taking over the .json.gz it was converted from"""
+    files = set(os.listdir(dataDir))
+    return sorted(f for f in files if f.endswith(metrics_columnar.SUFFIX) or
+                  (f.endswith('.json.gz') and metricName(f) + metrics_columnar.SUFFIX not in files))
+
+def metricName(f):
+    for suffix in ('.json.gz', metrics_columnar.SUFFIX):
+        if f.endswith(suffix):
+            return f[:-len(suffix)]
+    return f
+
+def iterSeries(path):
+    """
+    Yields the series of data.result one at a time straight off the gzip
+    stream, so only one series is ever decoded in memory instead of the whole
+    prometheus response. Files holding several responses one after the other
+    (one per line as the exporter writes them) are read through.
+    """
+    decoder = json.JSONDecoder()
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        buf = ''
+        pos = 0
+        while True:
+            # Look for the next "result" array, keeping enough of the tail
+            # for a key split between two reads
+            start = buf.find('"result"', pos)
+            if start == -1:
+                chunk = f.read(READ_SIZE)
+                if not chunk:
+                    return
+                buf = buf[max(pos, len(buf) - 8):] + chunk
+                pos = 0
+                continue
+            pos = start + len('"result"')
+            for expected in ':[':
+                buf, pos = fillUntil(f, buf, pos)
+                if buf[pos:pos + 1] != expected:
+                    raise ValueError('{}: unexpected json after "result"'.format(path))
+                pos += 1
+
+            while True:
+                buf, pos = fillUntil(f, buf, pos)
+                if buf[pos:pos + 1] == ',':
+                    buf, pos = fillUntil(f, buf, pos + 1)
+                if buf[pos:pos + 1] == ']':
+                    pos += 1
+                    break
+                readSize = READ_SIZE
+                while True:
+                    try:
+                        series, end = decoder.raw_decode(buf, pos)
+                        break
+                    except ValueError:
+                        # Series not fully read yet, grow the reads so a
+                        # huge one does not get decoded over and over
+                        chunk = f.read(readSize)
+                        if not chunk:
+                            raise
+                        buf = buf[pos:] + chunk
+                        pos = 0
+                        readSize = max(readSize, len(buf))
+                yield series
+                buf = buf[end:]
+                pos = 0
+
+def fillUntil(f, buf, pos):
+    """Skips whitespace, reading more of f until a meaningful character shows"""
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n':
+            pos += 1
+        if pos < len(buf):
+            return buf, pos
+        chunk = f.read(READ_SIZE)
+        if not chunk:
+            return buf, pos
+        buf = buf[pos:] + chunk
+        pos = 0
+
+class Checkpoint(object):
+    """
+    Records what carbon already got so that an interrupted import resumes.
+
+    A batch only counts once the sender wrote it to the socket. Batches of a
+    series can be written out of order by different senders, so the last
+    timestamp of a series only moves over batches sent without a gap before
+    them. A file is done when its producer finished and all its batches were
+    sent, it is then skipped as long as its size and mtime did not change.
+    The last timestamps of its series then give way to the last one of the
+    whole file, all of its points up to there being in carbon, which is what
+    an appended file resumes from. Saved atomically every PROGRESS_INTERVAL
+    when something changed and when the import ends.
+    """
+    def __init__(self, path, target, restart=False):
+        self.path = path
+        self.target = target
+        self.lock = threading.Lock()
+        self.files = {}
+        self.series = {}
+        # Series paths of every file started, dropped with the file once done
+        self.paths = {}
+        self.outstanding = {}
+        self.produced = set()
+        self.stats = {}
+        self.next = {}
+        self.early = {}
+        # A restart replaces the checkpoint there even if nothing gets sent
+        self.changed = restart
+        if restart or not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            print('WARNING: Ignoring unreadable checkpoint {}: {}'.format(path, e))
+            return
+        if state.get('target') != target:
+            print('WARNING: Checkpoint {} is for {}, starting over'.format(path, state.get('target')))
+            return
+        self.files = state.get('files', {})
+        self.series = state.get('series', {})
+
+    @staticmethod
+    def fileStat(fileName):
+        st = os.stat(fileName)
+        return [st.st_size, int(st.st_mtime)]
+
+    def fileDone(self, f, fileName):
+        return self.files.get(f, [])[:2] == self.fileStat(fileName)
+
+    def lastTimestamp(self, f, path):
+        with self.lock:
+            self.paths.setdefault(f, set()).add(path)
+            if path in self.series:
+                return self.series[path]
+            done = self.files.get(f)
+            return done[2] if done is not None and len(done) > 2 else None
+
+    def queued(self, f):
+        with self.lock:
+            self.outstanding[f] = self.outstanding.get(f, 0) + 1
+
+    def finished(self, f, stat):
+        """Producer of f queued all of its batches"""
+        with self.lock:
+            self.produced.add(f)
+            self.stats[f] = stat
+            self.fileProgress(f)
+
+    def sent(self, f, path, seq, timestamp):
+        """Batch seq of path written to carbon, timestamp being its last point"""
+        with self.lock:
+            if seq == self.next.get(path, 0):
+                self.moveSeries(path, seq, timestamp)
+            else:
+                self.early.setdefault(path, {})[seq] = timestamp
+            self.outstanding[f] -= 1
+            self.fileProgress(f)
+
+    def moveSeries(self, path, seq, timestamp):
+        early = self.early.get(path, {})
+        while True:
+            if timestamp > self.series.get(path, float('-inf')):
+                self.series[path] = timestamp
+                self.changed = True
+            seq += 1
+            if seq not in early:
+                break
+            timestamp = early.pop(seq)
+        self.next[path] = seq
+        if not early:
+            self.early.pop(path, None)
+
+    def fileProgress(self, f):
+        if f in self.produced and not self.outstanding.get(f):
+            done = self.files.get(f)
+            last = done[2] if done is not None and len(done) > 2 else None
+            # A timestamp for the whole file instead of one per series
+            for path in self.paths.pop(f, ()):
+                timestamp = self.series.pop(path, None)
+                if timestamp is not None and (last is None or timestamp > last):
+                    last = timestamp
+                self.next.pop(path, None)
+            self.files[f] = self.stats.pop(f) + [last]
+            self.produced.discard(f)
+            self.outstanding.pop(f, None)
+            self.changed = True
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            self.changed = False
+            state = {'target': self.target, 'files': dict(self.files), 'series': dict(self.series)}
+        tmp = '{}.tmp'.format(self.path)
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+def seriesValues(d):
+    # Range queries give values, instant ones a single value
+    if 'values' in d:
+        return d['values']
+    return [d['value']] if 'value' in d else []
+
+def readLabels(fileName):
+    """Labels of every series of a metric file, in file order"""
+    if fileName.endswith(metrics_columnar.SUFFIX):
+        with metrics_columnar.ColumnarFile(fileName) as cols:
+            return list(cols.labels())
+    return [d['metric'] for d in iterSeries(fileName)]
+
+def readPoints(fileName):
+    """Yields the (timestamp, value) points of every series of a metric file, in file order"""
+    if not fileName.endswith(metrics_columnar.SUFFIX):
+        for d in iterSeries(fileName):
+            yield seriesValues(d)
+        return
+    with metrics_columnar.ColumnarFile(fileName) as cols:
+        series = cols.series()
+        try:
+            for _, timestamps, values in series:
+                points = list(zip(timestamps.tolist(), values.tolist()))
+                # Views of the mapping have to be gone before it is closed
+                timestamps.release()
+                values.release()
+                yield points
+        finally:
+            series.close()
+
+def putBatch(batches, item, stop):
+    # Blocks while the senders are behind, gives up if they died
+    while not stop.is_set():
+        try:
+            batches.put(item, timeout=1)
+            return
+        except queue.Full:
+            continue
+    raise RuntimeError('carbon senders stopped')
+
+def produce(dataDir, f, serverName, batches, stop, checkpoint):
+    """
+    Streams one metric file and queues its points in batches for the senders,
+    leaving out the points the checkpoint says carbon already has
+    """
+    if stop.is_set():
+        # Interrupted before this file was started, left for the next run
+        return 0
+    fileName = os.path.join(dataDir, f)
+    stat = checkpoint.fileStat(fileName)
+    # Paths depend on the labels of every series, a first pass collects only
+    # those and the values are streamed on the second one
+    paths = labelPaths('{}.{}'.format(serverName, sanitize(metricName(f))), readLabels(fileName))
+    points = 0
+    seqs = {}
+    for values, path in zip(readPoints(fileName), paths):
+        last = checkpoint.lastTimestamp(f, path)
+        if last is not None:
+            values = [v for v in values if v[0] > last]
+        for i in range(0, len(values), QUEUE_BATCH):
+            seq = seqs.get(path, 0)
+            seqs[path] = seq + 1
+            checkpoint.queued(f)
+            putBatch(batches, (f, path, seq, values[i:i + QUEUE_BATCH]), stop)
+        points += len(values)
+    checkpoint.finished(f, stat)
+    return points
+
+def consume(sender, batches, stop, errors, checkpoint):
+    """
+    Sender thread, drains the queue into its own carbon connection and tells
+    the checkpoint about every batch once the sender wrote all of its points
+    """
+    # (points queued into the sender once the batch is in, batch) not yet written
+    marks = collections.deque()
+    def commit():
+        while marks and marks[0][0] <= sender.points:
+            f, path, seq, timestamp = marks.popleft()[1]
+            checkpoint.sent(f, path, seq, timestamp)
+    try:
+        while not stop.is_set():
+            try:
+                item = batches.get(timeout=1)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            f, path, seq, values = item
+            for v in values:
+                sender.send(path, v[1], v[0])
+            marks.append((sender.points + sender.pending, (f, path, seq, values[-1][0])))
+            commit()
+        sender.flush()
+        commit()
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        sender.close()
+
+class Progress(object):
+    """
+    Prints files done and points sent every PROGRESS_INTERVAL seconds, saving
+    the checkpoint along
+    """
+    def __init__(self, total, senders, checkpoint):
+        self.total = total
+        self.senders = senders
+        self.checkpoint = checkpoint
+        self.files = 0
+        self.started = time.time()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def sent(self):
+        return sum(s.points for s in self.senders)
+
+    def line(self):
+        spent = time.time() - self.started
+        return '{}/{} files, {} points sent in {:.1f}s ({:.0f} points/s)'.format(
+            self.files, self.total, self.sent(), spent, self.sent() / max(spent, 1e-9))
+
+    def run(self):
+        while not self.done.wait(PROGRESS_INTERVAL):
+            print('INFO: {}'.format(self.line()))
+            self.checkpoint.save()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        self.checkpoint.save()
+
+def parseArgs(args=None):
+    parser = argparse.ArgumentParser(description='Stream exported prometheus metrics into graphite')
+    parser.add_argument('dataDir', help='Directory containing the compressed json or .cols files')
+    parser.add_argument('--server', default=CARBON_SERVER, help='Carbon host (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=None,
+                        help='Carbon port (default: {} for plaintext, {} for pickle)'.format(
+                            CARBON_PORT, CARBON_PICKLE_PORT))
+    parser.add_argument('--protocol', choices=['plaintext', 'pickle'], default='plaintext',
+                        help='Carbon protocol, pickle is cheaper for large datasets (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help='Points per pickle message (default: %(default)s)')
+    parser.add_argument('--rate', type=int, default=RATE,
+                        help='Maximum points per second over all senders, 0 for no limit (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='Files decompressed and parsed in parallel (default: %(default)s)')
+    parser.add_argument('--senders', type=int, default=SENDERS,
+                        help='Parallel carbon connections (default: %(default)s)')
+    parser.add_argument('--checkpoint', default=None,
+                        help='Progress file for resuming an interrupted import '
+                             '(default: {} in dataDir)'.format(CHECKPOINT_FILE))
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore the checkpoint and send everything again')
+    opts = parser.parse_args(args)
+    if not os.path.isdir(opts.dataDir):
+        print('ERROR: "{}" is not a directory or not the full path to it'.format(opts.dataDir))
+        exit(2)
+    if opts.port is None:
+        opts.port = CARBON_PICKLE_PORT if opts.protocol == 'pickle' else CARBON_PORT
+    if opts.checkpoint is None:
+        opts.checkpoint = os.path.join(opts.dataDir, CHECKPOINT_FILE)
+    return opts
+
+def makeSender(opts):
+    # The rate limit is shared between the senders
+    rate = opts.rate / float(opts.senders) if opts.rate else 0
+    if opts.protocol == 'pickle':
+        return PickleSender(opts.server, opts.port, rate, opts.batch_size)
+    return CarbonSender(opts.server, opts.port, rate)
+
+def main():
+    opts = parseArgs()
+    dataDir = opts.dataDir
+    files = metricFiles(dataDir)
+    if not files:
+        print('ERROR: No .json.gz or .cols metric files in "{}"'.format(dataDir))
+        exit(2)
+
+    # metrics_<node>_<date> as written by export_node_metrics.py
+    dirName = os.path.basename(os.path.normpath(dataDir))
+    serverName = dirName[dirName.find('_')+1:dirName.rfind('_')].replace('.', '_')
+
+    # Already imported files are skipped, the others resume after the last
+    # point sent of each series
+    checkpoint = Checkpoint(opts.checkpoint, '{}:{}'.format(opts.server, opts.port), opts.restart)
+    todo = [f for f in files if not checkpoint.fileDone(f, os.path.join(dataDir, f))]
+    if len(todo) < len(files):
+        print('INFO: Skipping {} files already imported according to {}'.format(
+            len(files) - len(todo), opts.checkpoint))
+
+    # Parsers feed the carbon senders through a bounded queue, memory stays
+    # capped however far ahead of carbon the parsing gets
+    batches = queue.Queue(maxsize=QUEUE_SIZE)
+    stop = threading.Event()
+    errors = []
+    senders = [makeSender(opts) for _ in range(opts.senders)]
+    threads = [threading.Thread(target=consume, args=(s, batches, stop, errors, checkpoint))
+               for s in senders]
+    for t in threads:
+        t.start()
+    progress = Progress(len(files), senders, checkpoint)
+    progress.files = len(files) - len(todo)
+    progress.start()
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=opts.workers) as pool:
+        futures = {pool.submit(produce, dataDir, f, serverName, batches, stop, checkpoint): f
+                   for f in todo}
+        try:
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    if not stop.is_set():
+                        print('ERROR: Could not import {}: {}'.format(futures[future], e))
+                    failed += 1
+                progress.files += 1
+        except KeyboardInterrupt:
+            # Senders flush what they have so the checkpoint is as fresh as can be
+            print('WARNING: Interrupted, saving checkpoint to {}'.format(opts.checkpoint))
+            stop.set()
+            # Files not started yet are not read at all
+            pool.shutdown(wait=False, cancel_futures=True)
+            failed += 1
+
+    for _ in threads:
+        try:
+            putBatch(batches, None, stop)
+        except RuntimeError:
+            break
+    for t in threads:
+        t.join()
+    progress.stop()
+
+    for e in errors:
+        print('ERROR: Carbon sender failed: {}'.format(e))
+    print('INFO: Done, {}'.format(progress.line()))
+    if errors or failed:
+        exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+# Compact columnar file format for exported prometheus metrics
+# Author: Marc Methot
+#
+# Usage: python metrics_columnar.py convert PATH [PATH...]   (.json.gz files or directories)
+#        python metrics_columnar.py info FILE.cols
+#
+# A .cols file is a sequence of blocks, each one holding a set of series:
+#   8 bytes   MAGIC
+#   8 bytes   header length, little endian unsigned
+#   header    json {"series": [{"metric": {labels}, "count": points}, ...], "points": total}
+#             padded with spaces to a multiple of 8 bytes
+#   8 * total little endian float64 timestamps, series after series
+#   8 * total little endian float64 values, in the same order
+# The arrays are 8 byte aligned so they are read straight from an mmap without
+# a copy. Blocks are only ever appended, an export adds one per query window.
+
+import argparse
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+MAGIC = b'PMCOLS1\n'
+SUFFIX = '.cols'
+# Series per block written by the converter, bounds its memory
+CONVERT_SERIES = 1000
+
+def encodeBlock(result):
+    """Bytes of one block holding the series of a prometheus matrix result"""
+    series = []
+    timestamps = array.array('d')
+    values = array.array('d')
+    for d in result:
+        points = d['values'] if 'values' in d else [d['value']]
+        timestamps.extend([float(p[0]) for p in points])
+        # Prometheus sends values as strings, NaN and +Inf included
+        values.extend([float(p[1]) for p in points])
+        series.append({'metric': d['metric'], 'count': len(points)})
+    header = json.dumps({'series': series, 'points': len(timestamps)}).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+    if sys.byteorder != 'little':
+        timestamps.byteswap()
+        values.byteswap()
+    return b''.join([MAGIC, struct.pack('<Q', len(header)), header,
+                     timestamps.tobytes(), values.tobytes()])
+
+def appendBlock(fileName, result):
+    """Appends the series of result to fileName as one block, nothing for an empty result"""
+    if not result:
+        return
+    with open(fileName, 'ab') as f:
+        f.write(encodeBlock(result))
+
+class ColumnarFile(object):
+    """
+    Reads a .cols file through mmap.
+
+    series() yields (labels, timestamps, values) where timestamps and values
+    are float64 memoryviews into the mapping, nothing is copied. They must be
+    released (or dropped) before close(), as python refuses to unmap memory
+    still exported.
+    """
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.f = open(fileName, 'rb')
+        size = os.fstat(self.f.fileno()).st_size
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def blocks(self):
+        """Yields (header, offset of the timestamps) of every block"""
+        pos = 0
+        size = len(self.mm)
+        while pos < size:
+            if self.mm[pos:pos + 8] != MAGIC:
+                raise ValueError('{}: no block at offset {}'.format(self.fileName, pos))
+            headerSize = struct.unpack_from('<Q', self.mm, pos + 8)[0]
+            header = json.loads(self.mm[pos + 16:pos + 16 + headerSize].decode('utf-8'))
+            start = pos + 16 + headerSize
+            pos = start + 16 * header['points']
+            if pos > size:
+                raise ValueError('{}: truncated block at offset {}'.format(self.fileName, start))
+            yield header, start
+
+    def labels(self):
+        """Labels of every series, only the headers are read"""
+        for header, _ in self.blocks():
+            for s in header['series']:
+                yield s['metric']
+
+    def series(self):
+        view = memoryview(self.mm)
+        try:
+            for header, start in self.blocks():
+                timestamps = view[start:start + 8 * header['points']].cast('d')
+                values = view[start + 8 * header['points']:start + 16 * header['points']].cast('d')
+                if sys.byteorder != 'little':
+                    timestamps = swapped(timestamps)
+                    values = swapped(values)
+                offset = 0
+                for s in header['series']:
+                    yield s['metric'], timestamps[offset:offset + s['count']], values[offset:offset + s['count']]
+                    offset += s['count']
+                timestamps.release()
+                values.release()
+        finally:
+            view.release()
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.f.close()
+
+def swapped(view):
+    # Big endian hosts pay a copy
+    data = array.array('d', view)
+    data.byteswap()
+    return memoryview(data)
+
+def convert(fileName):
+    """Writes the .cols twin of a .json.gz export, returns its name"""
+    # The streaming decoder of the importer, imported here as it imports us
+    from import_metrics_to_graphite import iterSeries
+    target = fileName[:-len('.json.gz')] + SUFFIX
+    tmp = target + '.tmp'
+    batch = []
+    with open(tmp, 'wb') as f:
+        for d in iterSeries(fileName):
+            batch.append(d)
+            if len(batch) >= CONVERT_SERIES:
+                f.write(encodeBlock(batch))
+                batch = []
+        if batch:
+            f.write(encodeBlock(batch))
+    os.replace(tmp, target)
+    return target
+
+def exportFiles(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for f in sorted(os.listdir(path)):
+                if f.endswith('.json.gz'):
+                    yield os.path.join(path, f)
+        else:
+            yield path
+
+def main():
+    parser = argparse.ArgumentParser(description='Columnar files of exported prometheus metrics')
+    commands = parser.add_subparsers(dest='command')
+    convertParser = commands.add_parser('convert', help='Write a .cols file next to every .json.gz export')
+    convertParser.add_argument('paths', nargs='+', help='.json.gz files or directories holding them')
+    infoParser = commands.add_parser('info', help='Print the series of a .cols file')
+    infoParser.add_argument('file')
+    opts = parser.parse_args()
+
+    if opts.command == 'convert':
+        for fileName in exportFiles(opts.paths):
+            target = convert(fileName)
+            print('INFO: {} ({} bytes) -> {} ({} bytes)'.format(
+                fileName, os.path.getsize(fileName), target, os.path.getsize(target)))
+    elif opts.command == 'info':
+        with ColumnarFile(opts.file) as cols:
+            for labels, timestamps, values in cols.series():
+                if len(timestamps):
+                    print('{} {} points {:.0f} to {:.0f}'.format(
+                        json.dumps(labels, sort_keys=True), len(timestamps), timestamps[0], timestamps[-1]))
+                else:
+                    print('{} 0 points'.format(json.dumps(labels, sort_keys=True)))
+                timestamps.release()
+                values.release()
+    else:
+        parser.print_help()
+        exit(2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# Benchmark of metrics_columnar.py against the gzipped json exports
+# Author: Marc Methot
+#
+# Usage: python metrics_columnar_bench.py [--series 2000] [--samples 360]
+#
+# Series are counter and gauge like random walks with millisecond timestamps,
+# compressing about as well as real node metrics do.
+
+import argparse
+import gzip
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import import_metrics_to_graphite as importer
+import metrics_columnar
+
+def syntheticResult(series, samples, seed=42):
+    rand = random.Random(seed)
+    result = []
+    for i in range(series):
+        value = rand.random() * 1e6
+        timestamp = 1611662400.0
+        values = []
+        for _ in range(samples):
+            value += rand.random() * 100
+            timestamp += 30 + rand.choice([0, 0.001, -0.001])
+            values.append([round(timestamp, 3), '{:.2f}'.format(value) if i % 2 else str(rand.randint(0, 5))])
+        result.append({'metric': {'__name__': 'node_bench', 'instance': 'openshift-worker-1.example.com',
+                                  'cpu': str(i)}, 'values': values})
+    return result
+
+def writeJson(fileName, result):
+    # What export_node_metrics.py writes
+    data = {'status': 'success', 'data': {'resultType': 'matrix', 'result': result}}
+    with gzip.open(fileName, 'w') as f:
+        f.write(json.dumps(data).encode('utf-8'))
+        f.write(b'\n')
+
+def writeColumnar(fileName, result):
+    with open(fileName, 'wb') as f:
+        f.write(metrics_columnar.encodeBlock(result))
+
+def readPoints(fileName):
+    # Points as the importer gets them
+    return sum(len(points) for points in importer.readPoints(fileName))
+
+def readViews(fileName):
+    # Zero copy, only touching every value once
+    total = 0.0
+    with metrics_columnar.ColumnarFile(fileName) as cols:
+        for _, timestamps, values in cols.series():
+            total += sum(values)
+            timestamps.release()
+            values.release()
+    return total
+
+def timed(func, *args):
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser(description='metrics_columnar.py benchmark')
+    parser.add_argument('--series', type=int, default=2000, help='Series in the metric (default: 2000)')
+    parser.add_argument('--samples', type=int, default=360, help='Samples per series (default: 360)')
+    opts = parser.parse_args()
+
+    result = syntheticResult(opts.series, opts.samples)
+    points = opts.series * opts.samples
+    tmp = tempfile.mkdtemp(prefix='columnar_bench_')
+    try:
+        jsonFile = os.path.join(tmp, 'node_bench.json.gz')
+        colsFile = os.path.join(tmp, 'node_bench' + metrics_columnar.SUFFIX)
+        rows = [
+            ('gzip json', timed(writeJson, jsonFile, result), os.path.getsize(jsonFile),
+             timed(readPoints, jsonFile), None),
+            ('columnar', timed(writeColumnar, colsFile, result), os.path.getsize(colsFile),
+             timed(readPoints, colsFile), timed(readViews, colsFile)),
+        ]
+        with open(colsFile, 'rb') as f:
+            tarred = len(gzip.compress(f.read()))
+    finally:
+        shutil.rmtree(tmp)
+
+    print('{} series of {} samples, {} points'.format(opts.series, opts.samples, points))
+    print('{:<12}{:>10}{:>12}{:>14}{:>12}{:>14}'.format(
+        '', 'write s', 'bytes', 'bytes/point', 'import s', 'zero copy s'))
+    for name, write, size, read, views in rows:
+        print('{:<12}{:>10.2f}{:>12}{:>14.2f}{:>12.2f}{:>14}'.format(
+            name, write, size, size / float(points), read, '' if views is None else '{:.3f}'.format(views)))
+    print('columnar file gzipped, as it ends up in the export tarball: {} bytes ({:.2f} bytes/point)'.format(
+        tarred, tarred / float(points)))
+
+if __name__ == '__main__':
+    main()
@@ -9,24 +9,44 @@ non-hyperconverged environment.
 
 Usage:
     python3 collect_odf_metrics.py [--output-dir OUTPUT_DIR] [--time-range RANGE]
+                                   [--max-workers N] [--step STEP] [--max-points N]
+                                   [--from-store] [--csv-layout long|wide] [--compress]
+                                   [--parquet] [--cache-dir DIR]
     
     --output-dir: Directory to save collected metrics (default: ./odf_metrics)
     --time-range: Time range for queries in Prometheus format (default: 1h)
+    --max-workers: Queries run in parallel (default: 8)
+    --step: Resolution of the queries (default: 30s)
+    --max-points: Points per series of one request (default: 11000)
+    --from-store: Rebuild the JSON, CSV and summary from the results already
+                  in --output-dir, without querying Prometheus
+    --csv-layout: long, a row per point, or wide, a column per series (default: long)
+    --compress: Write .csv.gz files
+    --parquet: Also write Parquet files (needs pandas and pyarrow)
+    --cache-dir: Keep query results there, reruns only query what is missing
 """
 
 import argparse
 import base64
+import hashlib
 import json
+import math
 import os
 import sys
+import threading
 import time
+from collections import Counter
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Dict, List, Any, Optional
 import csv
+import gzip
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter
     from requests.auth import HTTPBasicAuth
 except ImportError:
     print("Error: 'requests' library is required. Install with: pip install requests")
@@ -39,15 +59,226 @@ except ImportError:
     print("Error: 'kubernetes' library is required. Install with: pip install kubernetes")
     sys.exit(1)
 
+# Queries sent to Prometheus at the same time
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_STEP = '30s'
+# Prometheus refuses query_range requests of more points per series
+DEFAULT_MAX_POINTS = 11000
+# Sub-range requests per query before the step is coarsened instead
+MAX_SUB_RANGES = 8
+QUERY_TIMEOUT = 30
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+# Results of every query as they come, one json record per line
+STORE_FILE = 'odf_metrics.ndjson'
+MANIFEST_FILE = 'odf_metrics_manifest.json'
+DEFAULT_CACHE_TTL = '7d'
+DEFAULT_CACHE_MAX_MB = 1024
+# Points this recent may still be ingested by Prometheus, they are never cached
+CACHE_SETTLE = 300
+
+
+def parse_duration(value: str) -> int:
+    """Seconds of a Prometheus style duration such as 30s, 5m, 6h or 7d"""
+    if value[-1:] in DURATION_UNITS:
+        return int(value[:-1]) * DURATION_UNITS[value[-1]]
+    return int(value)
+
+
+class MetricsStore(Mapping):
+    """
+    Query results streamed to disk
+
+    Every distinct query is appended to STORE_FILE as one {"query", "results"}
+    record once it completes, and MANIFEST_FILE is rewritten with its offset.
+    The manifest only points at whole records and says whether the run
+    completed, so the results of a run that died are still readable.
+
+    Reads like the collected metrics dict, category -> metric -> results,
+    categories and metrics without results left out. Results are read from
+    disk when looked up, one metric at a time.
+    """
+    
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.store_file = self.directory / STORE_FILE
+        self.manifest_file = self.directory / MANIFEST_FILE
+        self.manifest = {'categories': {}, 'queries': {}, 'complete': False}
+        self._out = None
+    
+    @classmethod
+    def load(cls, directory: Path) -> 'MetricsStore':
+        """Store of an earlier run in directory"""
+        store = cls(directory)
+        with open(store.manifest_file) as f:
+            store.manifest = json.load(f)
+        return store
+    
+    def create(self, categories: Dict[str, List[str]], **info):
+        """Starts a new, empty store, info is kept in the manifest"""
+        self.manifest = dict(info, categories=categories, queries={}, complete=False)
+        self._out = open(self.store_file, 'wb')
+        self._save_manifest()
+    
+    def add(self, query: str, results: List[Dict]):
+        """Appends the results of query, on disk before this returns"""
+        record = json.dumps({'query': query, 'results': results}, default=str).encode('utf-8') + b'\n'
+        offset = self._out.tell()
+        self._out.write(record)
+        self._out.flush()
+        self.manifest['queries'][query] = {'offset': offset, 'length': len(record), 'series': len(results)}
+        self._save_manifest()
+    
+    def close(self, complete: bool = True):
+        if self._out:
+            self._out.close()
+            self._out = None
+            self.manifest['complete'] = complete
+            self._save_manifest()
+    
+    def _save_manifest(self):
+        tmp = self.manifest_file.with_name(self.manifest_file.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp, self.manifest_file)
+    
+    def series(self, query: str) -> int:
+        """Series found by query, 0 when it found none or is not stored"""
+        return self.manifest['queries'].get(query, {}).get('series', 0)
+    
+    def results(self, query: str) -> List[Dict]:
+        entry = self.manifest['queries'][query]
+        with open(self.store_file, 'rb') as f:
+            f.seek(entry['offset'])
+            return json.loads(f.read(entry['length']))['results']
+    
+    def _metrics(self, category: str) -> List[str]:
+        return [q for q in self.manifest['categories'].get(category, []) if self.series(q)]
+    
+    def __getitem__(self, category: str) -> 'StoredCategory':
+        if not self._metrics(category):
+            raise KeyError(category)
+        return StoredCategory(self, category)
+    
+    def __iter__(self):
+        return (c for c in self.manifest['categories'] if self._metrics(c))
+    
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class StoredCategory(Mapping):
+    """Metrics of one category of a MetricsStore, metric -> results"""
+    
+    def __init__(self, store: MetricsStore, category: str):
+        self.store = store
+        self.category = category
+    
+    def __getitem__(self, metric: str) -> List[Dict]:
+        if metric not in self.store._metrics(self.category):
+            raise KeyError(metric)
+        return self.store.results(metric)
+    
+    def __iter__(self):
+        return iter(self.store._metrics(self.category))
+    
+    def __len__(self):
+        return len(self.store._metrics(self.category))
+
+
+class QueryCache:
+    """
+    query_range results on disk, one file per query, step and time bucket
+
+    Buckets are the epoch aligned sub-ranges of PrometheusODFCollector, so
+    the same bucket comes back on every run until it moves out of the time
+    range. An entry records the part of its bucket it covers, a rerun only
+    queries what follows it. Entries expire ttl seconds after their last
+    use, the least recently used ones go first once the cache is over
+    max_bytes.
+    """
+    
+    def __init__(self, directory: str, ttl: int = parse_duration(DEFAULT_CACHE_TTL),
+                 max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats = Counter()
+        self._lock = threading.Lock()
+    
+    def _path(self, url: str, query: str, step: int, bucket: int) -> Path:
+        key = json.dumps([url, query, step, bucket])
+        return self.directory / f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.json"
+    
+    def count(self, outcome: str):
+        with self._lock:
+            self.stats[outcome] += 1
+    
+    def get(self, url: str, query: str, step: int, bucket: int) -> Optional[Dict]:
+        """{"start", "end", "results"} of the bucket, None if missing or expired"""
+        path = self._path(url, query, step, bucket)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                path.unlink()
+                return None
+            with open(path) as f:
+                entry = json.load(f)
+            # mtime is the last use
+            os.utime(path)
+            return entry
+        except (OSError, ValueError):
+            return None
+    
+    def put(self, url: str, query: str, step: int, bucket: int, start: int, end: int,
+            results: List[Dict]):
+        path = self._path(url, query, step, bucket)
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        with open(tmp, 'w') as f:
+            json.dump({'query': query, 'step': step, 'start': start, 'end': end, 'results': results}, f)
+        os.replace(tmp, path)
+    
+    def evict(self) -> int:
+        """Removes expired entries, then the least recently used over max_bytes, returns how many"""
+        entries = []
+        for path in self.directory.glob('*.json'):
+            try:
+                entries.append((path.stat(), path))
+            except OSError:
+                continue
+        entries.sort(key=lambda entry: entry[0].st_mtime)
+        total = sum(stat.st_size for stat, _ in entries)
+        now = time.time()
+        removed = 0
+        for stat, path in entries:
+            if now - stat.st_mtime <= self.ttl and total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= stat.st_size
+            removed += 1
+        return removed
+
 
 class PrometheusODFCollector:
     """Collector for ODF/Ceph metrics from Prometheus"""
     
-    def __init__(self, namespace: str = "openshift-monitoring", output_dir: str = "./odf_metrics"):
+    def __init__(self, namespace: str = "openshift-monitoring", output_dir: str = "./odf_metrics",
+                 max_workers: int = DEFAULT_MAX_WORKERS, step: str = DEFAULT_STEP,
+                 max_points: int = DEFAULT_MAX_POINTS, cache: Optional[QueryCache] = None):
         self.namespace = namespace
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.max_workers = max_workers
+        self.step = parse_duration(step)
+        self.max_points = max_points
+        self.cache = cache
         self.session = requests.Session()
+        # One pooled connection per worker, requests keeps 10 by default
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         self.prometheus_url = None
         self.token = None
         
@@ -231,8 +462,8 @@ class PrometheusODFCollector:
         
         return True
     
-    def query_prometheus(self, query: str, time_range: str = "1h") -> List[Dict]:
-        """Execute a Prometheus query"""
+    def _time_window(self, time_range: str, end_time: Optional[datetime] = None):
+        """Start and end timestamps of the last time_range up to end_time (default: now)"""
         # Parse time range
         hours = 1
         if time_range.endswith('h'):
@@ -240,19 +471,49 @@ class PrometheusODFCollector:
         elif time_range.endswith('d'):
             hours = int(time_range[:-1]) * 24
         
-        end_time = datetime.now()
+        end_time = end_time or datetime.now()
         start_time = end_time - timedelta(hours=hours)
+        return start_time.timestamp(), end_time.timestamp()
+    
+    def _plan_ranges(self, start: float, end: float):
+        """
+        Step and sub-ranges covering start to end, none over max_points points
+
+        The configured step is kept as long as about MAX_SUB_RANGES requests
+        are enough, past that it is coarsened to a multiple of itself. Start
+        and end are moved down to a multiple of the step and sub-ranges are
+        the parts of epoch aligned buckets of max_points points, so their
+        points are the ones a single request would have returned, without
+        overlap, and a later run gets the same buckets back for QueryCache.
+        """
+        step = self.step
+        span = end - start
+        limit = MAX_SUB_RANGES * self.max_points - 1
+        if span / step > limit:
+            step *= math.ceil(span / (limit * step))
         
+        start = int(start) - int(start) % step
+        end = int(end) - int(end) % step
+        width = self.max_points * step
+        ranges = []
+        while start <= end:
+            sub_end = min(start - start % width + width - step, end)
+            ranges.append((start, sub_end))
+            start = sub_end + step
+        return step, ranges
+    
+    def _query_range(self, query: str, start: float, end: float, step: int) -> Optional[List[Dict]]:
+        """Execute one query_range request, None when it failed"""
         url = f"{self.prometheus_url}/api/v1/query_range"
         params = {
             'query': query,
-            'start': start_time.timestamp(),
-            'end': end_time.timestamp(),
-            'step': '30s'
+            'start': start,
+            'end': end,
+            'step': f"{step}s"
         }
         
         try:
-            response = self.session.get(url, params=params, verify=False, timeout=30)
+            response = self.session.get(url, params=params, verify=False, timeout=QUERY_TIMEOUT)
             response.raise_for_status()
             data = response.json()
             
@@ -260,10 +521,82 @@ class PrometheusODFCollector:
                 return data.get('data', {}).get('result', [])
             else:
                 print(f"Query failed: {data.get('error', 'Unknown error')}")
-                return []
+                return None
         except Exception as e:
             print(f"Error executing query '{query[:50]}...': {e}")
-            return []
+            return None
+    
+    @staticmethod
+    def _slice_results(results: List[Dict], start: int, end: int) -> List[Dict]:
+        """Points of results from start to end, series left without any dropped"""
+        sliced = []
+        for result in results:
+            values = [v for v in result.get('values', []) if start <= float(v[0]) <= end]
+            if values:
+                sliced.append({'metric': result.get('metric', {}), 'values': values})
+        return sliced
+    
+    def _fetch_range(self, query: str, start: int, end: int, step: int) -> Optional[List[Dict]]:
+        """
+        _query_range through the cache, when there is one
+
+        start and end are within one bucket of _plan_ranges. A cached entry
+        covering them is served from disk, one ending earlier is completed
+        with a request for the missing tail only. What is older than
+        CACHE_SETTLE seconds is then stored back.
+        """
+        if not self.cache:
+            return self._query_range(query, start, end, step)
+        
+        bucket = start // (self.max_points * step)
+        entry = self.cache.get(self.prometheus_url, query, step, bucket)
+        if entry and entry['start'] <= start and entry['end'] >= end:
+            self.cache.count('hits')
+            return self._slice_results(entry['results'], start, end)
+        
+        if entry and entry['start'] <= start and entry['end'] >= start - step:
+            self.cache.count('partial')
+            fresh = self._query_range(query, entry['end'] + step, end, step)
+            if fresh is None:
+                return None
+            results = self._merge_results([entry['results'], fresh])
+            cached_start, known_end = entry['start'], entry['end']
+        else:
+            self.cache.count('misses')
+            results = self._query_range(query, start, end, step)
+            if results is None:
+                return None
+            cached_start, known_end = start, start - step
+        
+        settled = int(time.time()) - CACHE_SETTLE
+        cached_end = min(end, settled - settled % step)
+        if cached_end > known_end:
+            self.cache.put(self.prometheus_url, query, step, bucket, cached_start, cached_end,
+                           self._slice_results(results, cached_start, cached_end))
+        return self._slice_results(results, start, end)
+    
+    @staticmethod
+    def _merge_results(parts: List[Optional[List[Dict]]]) -> List[Dict]:
+        """One series per label set out of the results of consecutive sub-ranges, failed ones are None"""
+        if len(parts) == 1:
+            return parts[0] or []
+        merged = {}
+        for results in parts:
+            for result in results or []:
+                key = tuple(sorted(result.get('metric', {}).items()))
+                if key in merged:
+                    merged[key]['values'].extend(result.get('values', []))
+                else:
+                    merged[key] = {'metric': result.get('metric', {}),
+                                   'values': list(result.get('values', []))}
+        return list(merged.values())
+    
+    def query_prometheus(self, query: str, time_range: str = "1h",
+                         end_time: Optional[datetime] = None) -> List[Dict]:
+        """Execute a Prometheus query, over time_range up to end_time (default: now)"""
+        start, end = self._time_window(time_range, end_time)
+        step, ranges = self._plan_ranges(start, end)
+        return self._merge_results([self._fetch_range(query, s, e, step) for s, e in ranges])
     
     def get_odf_metrics_queries(self) -> Dict[str, List[str]]:
         """Define all ODF/Ceph related Prometheus queries"""
@@ -351,80 +684,212 @@ class PrometheusODFCollector:
             ]
         }
     
-    def collect_metrics(self, time_range: str = "1h"):
-        """Collect all ODF metrics"""
+    def collect_metrics(self, time_range: str = "1h", max_workers: Optional[int] = None):
+        """
+        Collect all ODF metrics
+
+        Every distinct query runs once, max_workers at a time over the shared
+        session, all of them over the same time window. Ranges over max_points
+        points are split into sub-range requests, merged back into one series
+        per label set. Each query is written to the MetricsStore of output_dir
+        as soon as it completes, only the queries still in flight are held in
+        memory. The store returned reads per category as if each category had
+        run its own queries.
+        """
+        max_workers = max_workers or self.max_workers
+        queries = self.get_odf_metrics_queries()
+        # Some queries belong to several categories, dict keeps the first seen order
+        unique = list(dict.fromkeys(q for metric_list in queries.values() for q in metric_list))
+        
+        start, end = self._time_window(time_range)
+        step, ranges = self._plan_ranges(start, end)
+        
         print(f"\nCollecting ODF/Ceph metrics (time range: {time_range})...")
+        print(f"Running {len(unique)} distinct queries with {max_workers} workers, "
+              f"step {step}s, {len(ranges)} sub-range(s) per query...")
         print("=" * 80)
         
-        all_metrics = {}
-        queries = self.get_odf_metrics_queries()
+        store = MetricsStore(self.output_dir)
+        store.create(queries, time_range=time_range, start=ranges[0][0], end=ranges[-1][1], step=step)
+        # Sub-ranges of every query go to the pool on their own, a long range
+        # does not hold a worker for the whole of its requests
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {}
+            for q in unique:
+                for i, (s, e) in enumerate(ranges):
+                    futures[pool.submit(self._fetch_range, q, s, e, step)] = (q, i)
+            parts = {}
+            remaining = dict.fromkeys(unique, len(ranges))
+            try:
+                for future in as_completed(futures):
+                    # A future holds on to its result, only pending ones are kept
+                    q, i = futures.pop(future)
+                    parts.setdefault(q, [None] * len(ranges))[i] = future.result()
+                    remaining[q] -= 1
+                    if not remaining[q]:
+                        store.add(q, self._merge_results(parts.pop(q)))
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                store.close(complete=False)
+                raise
+        store.close()
+        if self.cache:
+            evicted = self.cache.evict()
+            print(f"Query cache: {self.cache.stats['hits']} hit(s), {self.cache.stats['partial']} "
+                  f"completed with a tail request, {self.cache.stats['misses']} miss(es), "
+                  f"{evicted} entrie(s) evicted")
         
         for category, metric_list in queries.items():
             print(f"\nCollecting {category} metrics...")
-            category_metrics = {}
-            
             for metric in metric_list:
                 print(f"  Querying: {metric}")
-                results = self.query_prometheus(metric, time_range)
-                if results:
-                    category_metrics[metric] = results
-                    print(f"    Found {len(results)} result(s)")
+                if store.series(metric):
+                    print(f"    Found {store.series(metric)} result(s)")
                 else:
                     print(f"    No results found")
-            
-            if category_metrics:
-                all_metrics[category] = category_metrics
         
-        return all_metrics
+        return store
     
-    def save_metrics_json(self, metrics: Dict, filename: str = "odf_metrics.json"):
-        """Save metrics to JSON file"""
+    def save_metrics_json(self, metrics: Mapping, filename: str = "odf_metrics.json"):
+        """
+        Save metrics to JSON file
+
+        Written one metric at a time, the same document json.dump(metrics,
+        indent=2) would give, so a MetricsStore is never loaded as a whole.
+        """
         output_file = self.output_dir / filename
         with open(output_file, 'w') as f:
-            json.dump(metrics, f, indent=2, default=str)
+            f.write('{')
+            for i, (category, category_metrics) in enumerate(metrics.items()):
+                f.write(f"{',' if i else ''}\n  {json.dumps(category)}: {{")
+                for j, (metric_name, results) in enumerate(category_metrics.items()):
+                    # json strings hold no raw newline, indenting every line is safe
+                    dumped = json.dumps(results, indent=2, default=str).replace('\n', '\n    ')
+                    f.write(f"{',' if j else ''}\n    {json.dumps(metric_name)}: {dumped}")
+                f.write('\n  }' if category_metrics else '}')
+            f.write('\n}' if metrics else '}')
         print(f"\nMetrics saved to: {output_file}")
     
-    def save_metrics_csv(self, metrics: Dict):
-        """Save metrics to CSV files for easier analysis"""
+    @staticmethod
+    def _points(result: Dict) -> List:
+        """[timestamp, value] pairs of a range or instant result"""
+        if 'values' in result:
+            return result['values']
+        return [result['value']] if 'value' in result else []
+    
+    @staticmethod
+    def _label_columns(category_metrics: Mapping) -> List[str]:
+        """Union of the labels of every series, in first seen order"""
+        return list(dict.fromkeys(label for results in category_metrics.values()
+                                  for result in results for label in result.get('metric', {})))
+    
+    @staticmethod
+    def _timestamp_formatter():
+        """isoformat of timestamps, every series of a query shares them so each is only formatted once"""
+        formatted = {}
+        
+        def format_timestamp(timestamp):
+            text = formatted.get(timestamp)
+            if text is None:
+                text = formatted[timestamp] = datetime.fromtimestamp(float(timestamp)).isoformat()
+            return text
+        return format_timestamp
+    
+    def _write_long(self, writer, category_metrics: Mapping):
+        """One row per point: metric, timestamp, every label of the category, value"""
+        # First pass for the columns, a MetricsStore reads each metric again in the second
+        labels = self._label_columns(category_metrics)
+        format_timestamp = self._timestamp_formatter()
+        writer.writerow(['metric', 'timestamp'] + labels + ['value'])
+        for metric_name, results in category_metrics.items():
+            for result in results:
+                series = [result.get('metric', {}).get(label, '') for label in labels]
+                writer.writerows([metric_name, format_timestamp(timestamp)] + series + [value]
+                                 for timestamp, value in self._points(result))
+    
+    def _write_wide(self, writer, category_metrics: Mapping):
+        """One row per timestamp, one column per series named metric{labels}"""
+        format_timestamp = self._timestamp_formatter()
+        columns = []
+        rows = {}
+        for metric_name, results in category_metrics.items():
+            for result in results:
+                labels = ','.join(f'{k}="{v}"' for k, v in sorted(result.get('metric', {}).items())
+                                  if k != '__name__')
+                column = len(columns)
+                columns.append(f"{metric_name}{{{labels}}}" if labels else metric_name)
+                for timestamp, value in self._points(result):
+                    rows.setdefault(timestamp, {})[column] = value
+        writer.writerow(['timestamp'] + columns)
+        for timestamp in sorted(rows, key=float):
+            values = rows[timestamp]
+            writer.writerow([format_timestamp(timestamp)] + [values.get(c, '') for c in range(len(columns))])
+    
+    def save_metrics_csv(self, metrics: Mapping, layout: str = 'long', compress: bool = False):
+        """
+        Save metrics to CSV files for easier analysis, one per category
+
+        Every series is written. The long layout has a row per point with
+        one column per label, it is read as is by pandas.read_csv(). The wide
+        layout has a row per timestamp and a column per series, it holds a
+        whole category in memory to build. compress writes .csv.gz files.
+        """
         for category, category_metrics in metrics.items():
-            csv_file = self.output_dir / f"{category}_metrics.csv"
+            csv_file = self.output_dir / f"{category}_metrics.csv{'.gz' if compress else ''}"
             
-            with open(csv_file, 'w', newline='') as f:
+            if compress:
+                f = gzip.open(csv_file, 'wt', newline='')
+            else:
+                f = open(csv_file, 'w', newline='')
+            with f:
                 writer = csv.writer(f)
-                
-                for metric_name, results in category_metrics.items():
-                    if not results:
-                        continue
-                    
-                    # Write metric name as header
-                    writer.writerow([f"Metric: {metric_name}"])
-                    
-                    # Write headers
-                    if results:
-                        first_result = results[0]
-                        if 'metric' in first_result:
-                            labels = list(first_result['metric'].keys())
-                            writer.writerow(['timestamp'] + labels + ['value'])
-                            
-                            # Write data rows
-                            if 'values' in first_result:
-                                for timestamp, value in first_result['values']:
-                                    row = [datetime.fromtimestamp(timestamp).isoformat()] + \
-                                          [first_result['metric'].get(label, '') for label in labels] + \
-                                          [value]
-                                    writer.writerow(row)
-                            elif 'value' in first_result:
-                                timestamp, value = first_result['value']
-                                row = [datetime.fromtimestamp(timestamp).isoformat()] + \
-                                      [first_result['metric'].get(label, '') for label in labels] + \
-                                      [value]
-                                writer.writerow(row)
-                    
-                    writer.writerow([])  # Empty row between metrics
+                if layout == 'wide':
+                    self._write_wide(writer, category_metrics)
+                else:
+                    self._write_long(writer, category_metrics)
             
             print(f"CSV saved to: {csv_file}")
     
-    def generate_summary_report(self, metrics: Dict):
+    def save_metrics_parquet(self, metrics: Mapping) -> bool:
+        """Save metrics to Parquet files, one per category in the long layout of the CSV files"""
+        try:
+            import pandas as pd
+        except ImportError:
+            print("Error: 'pandas' and 'pyarrow' are required for Parquet output. "
+                  "Install with: pip install pandas pyarrow")
+            return False
+        
+        for category, category_metrics in metrics.items():
+            labels = self._label_columns(category_metrics)
+            columns = {'metric': [], 'timestamp': [], **{label: [] for label in labels}, 'value': []}
+            for metric_name, results in category_metrics.items():
+                for result in results:
+                    points = self._points(result)
+                    columns['metric'].extend([metric_name] * len(points))
+                    for label in labels:
+                        columns[label].extend([result.get('metric', {}).get(label)] * len(points))
+                    columns['timestamp'].extend(timestamp for timestamp, _ in points)
+                    columns['value'].extend(value for _, value in points)
+            
+            frame = pd.DataFrame(columns)
+            frame['metric'] = frame['metric'].astype('category')
+            for label in labels:
+                frame[label] = frame[label].astype('category')
+            frame['timestamp'] = pd.to_datetime(frame['timestamp'].astype(float), unit='s', utc=True)
+            # NaN and +Inf come as strings too
+            frame['value'] = frame['value'].astype(float)
+            
+            parquet_file = self.output_dir / f"{category}_metrics.parquet"
+            try:
+                frame.to_parquet(parquet_file, index=False)
+            except ImportError as e:
+                print(f"Error: {e}")
+                return False
+            print(f"Parquet saved to: {parquet_file}")
+        return True
+    
+    def generate_summary_report(self, metrics: Mapping):
         """Generate a summary report of key metrics"""
         report_file = self.output_dir / "odf_metrics_summary.txt"
         
@@ -485,6 +950,19 @@ Examples:
   
   # Save to custom directory
   python3 collect_odf_metrics.py --output-dir /tmp/odf_data
+  
+  # A week at 30s, split into requests of at most 5000 points per series
+  python3 collect_odf_metrics.py --time-range 7d --max-points 5000
+  
+  # Rebuild the reports of an earlier, maybe interrupted, run
+  python3 collect_odf_metrics.py --output-dir /tmp/odf_data --from-store
+  
+  # Compressed CSV and Parquet files, for pandas
+  python3 collect_odf_metrics.py --time-range 7d --compress --parquet
+  
+  # Rerun with other outputs, only the points since the first run are queried
+  python3 collect_odf_metrics.py --time-range 7d --cache-dir ~/.cache/odf_metrics
+  python3 collect_odf_metrics.py --time-range 7d --cache-dir ~/.cache/odf_metrics --csv-layout wide
         """
     )
     parser.add_argument(
@@ -507,17 +985,93 @@ Examples:
         default=None,
         help='Direct Prometheus URL (if not using route discovery, e.g., http://localhost:9090)'
     )
+    parser.add_argument(
+        '--max-workers',
+        type=int,
+        default=DEFAULT_MAX_WORKERS,
+        help=f'Queries run in parallel against Prometheus (default: {DEFAULT_MAX_WORKERS})'
+    )
+    parser.add_argument(
+        '--step',
+        default=DEFAULT_STEP,
+        help=f'Query resolution, coarsened when the range needs more than {MAX_SUB_RANGES} '
+             f'requests per query (default: {DEFAULT_STEP})'
+    )
+    parser.add_argument(
+        '--max-points',
+        type=int,
+        default=DEFAULT_MAX_POINTS,
+        help=f'Points per series of one request, longer ranges are split '
+             f'(default: {DEFAULT_MAX_POINTS}, the Prometheus limit)'
+    )
+    
+    parser.add_argument(
+        '--from-store',
+        action='store_true',
+        help=f'Rebuild the JSON, CSV and summary from {STORE_FILE} in --output-dir, '
+             f'no query is sent'
+    )
+    parser.add_argument(
+        '--csv-layout',
+        choices=['long', 'wide'],
+        default='long',
+        help='CSV layout, a row per point with a column per label, or a row per '
+             'timestamp with a column per series (default: long)'
+    )
+    parser.add_argument(
+        '--compress',
+        action='store_true',
+        help='Write gzip compressed .csv.gz files'
+    )
+    parser.add_argument(
+        '--parquet',
+        action='store_true',
+        help='Also write a Parquet file per category (needs pandas and pyarrow)'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        default=None,
+        help='Cache query results there, a rerun only queries the points it does not have yet '
+             '(default: no cache)'
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        default=DEFAULT_CACHE_TTL,
+        help=f'Cached results unused for this long are dropped (default: {DEFAULT_CACHE_TTL})'
+    )
+    parser.add_argument(
+        '--cache-max-mb',
+        type=int,
+        default=DEFAULT_CACHE_MAX_MB,
+        help=f'Least recently used results are dropped past this size (default: {DEFAULT_CACHE_MAX_MB})'
+    )
     
     args = parser.parse_args()
+    if args.max_points < 2:
+        parser.error('--max-points must be at least 2')
     
     # Initialize collector
     collector = PrometheusODFCollector(
         namespace=args.namespace,
-        output_dir=args.output_dir
+        output_dir=args.output_dir,
+        max_workers=args.max_workers,
+        step=args.step,
+        max_points=args.max_points,
+        cache=QueryCache(args.cache_dir, parse_duration(args.cache_ttl), args.cache_max_mb * 1024 * 1024)
+        if args.cache_dir else None
     )
     
+    if args.from_store:
+        try:
+            metrics = MetricsStore.load(collector.output_dir)
+        except FileNotFoundError:
+            print(f"\nError: no {MANIFEST_FILE} in {collector.output_dir}")
+            sys.exit(1)
+        if not metrics.manifest['complete']:
+            print(f"Warning: the run that wrote {collector.output_dir} did not complete, "
+                  f"{len(metrics.manifest['queries'])} queries were stored")
     # Override Prometheus URL if provided
-    if args.prometheus_url:
+    elif args.prometheus_url:
         collector.prometheus_url = args.prometheus_url
         collector.token = None  # Will try to get token
         collector.setup_kubernetes_client()
@@ -529,7 +1083,8 @@ Examples:
             sys.exit(1)
     
     # Collect metrics
-    metrics = collector.collect_metrics(time_range=args.time_range)
+    if not args.from_store:
+        metrics = collector.collect_metrics(time_range=args.time_range)
     
     if not metrics:
         print("\nWarning: No metrics collected. Check Prometheus queries and access.")
@@ -537,7 +1092,9 @@ Examples:
     
     # Save results
     collector.save_metrics_json(metrics)
-    collector.save_metrics_csv(metrics)
+    collector.save_metrics_csv(metrics, layout=args.csv_layout, compress=args.compress)
+    if args.parquet:
+        collector.save_metrics_parquet(metrics)
     collector.generate_summary_report(metrics)
     
     print("\n" + "=" * 80)
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Benchmark of PrometheusODFCollector.collect_metrics against a local fake Prometheus
+
+Usage:
+    python3 collect_odf_metrics_bench.py [--latency 0.05] [--slow 3] [--slow-latency 1.0]
+                                         [--series 4] [--max-workers 8] [--long-range 7d]
+                                         [--cache-range 1d]
+
+FakePrometheus answers /api/v1/query_range with synthetic series after
+--latency seconds, --slow of the queries taking --slow-latency seconds instead,
+and refuses requests over 11000 points per series like Prometheus does, so no
+cluster is needed. It can also stand in for a real Prometheus:
+    python3 collect_odf_metrics.py --prometheus-url http://127.0.0.1:PORT
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from collect_odf_metrics import PrometheusODFCollector, QueryCache, DEFAULT_MAX_POINTS, DEFAULT_MAX_WORKERS
+
+
+class FakePrometheus:
+    """Threaded HTTP server answering query_range like Prometheus"""
+
+    def __init__(self, series: int = 4, latency: float = 0.0, slow: List[str] = (),
+                 slow_latency: float = 0.0):
+        self.series = series
+        self.latency = latency
+        self.slow = set(slow)
+        self.slow_latency = slow_latency
+        self.queries = 0
+        self.points = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with fake.lock:
+                    fake.connections += 1
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != '/api/v1/query_range':
+                    self.send_error(404)
+                    return
+                params = parse_qs(url.query)
+                query = params['query'][0]
+                time.sleep(fake.slow_latency if query in fake.slow else fake.latency)
+                with fake.lock:
+                    fake.queries += 1
+                start, end = float(params['start'][0]), float(params['end'][0])
+                step = float(params['step'][0].rstrip('s'))
+                if (end - start) / step + 1 > DEFAULT_MAX_POINTS:
+                    status = 400
+                    body = {'status': 'error', 'errorType': 'bad_data',
+                            'error': 'exceeded maximum resolution of 11,000 points per timeseries. '
+                                     'Try decreasing the query resolution (?step=XX)'}
+                else:
+                    status = 200
+                    body = fake.query_range(query, start, end, step)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+
+    def query_range(self, query: str, start: float, end: float, step: float) -> Dict:
+        times = [start + step * i for i in range(int((end - start) // step) + 1)]
+        with self.lock:
+            self.points += len(times) * self.series
+        result = [
+            {
+                'metric': {'__name__': query.split('(')[-1].split('{')[0].split('[')[0],
+                           'pool_id': str(s)},
+                'values': [[t, str(float(s * t % 1000))] for t in times],
+            }
+            for s in range(self.series)
+        ]
+        return {'status': 'success', 'data': {'resultType': 'matrix', 'result': result}}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def legacy_collect(collector: PrometheusODFCollector, time_range: str) -> Dict[str, Dict]:
+    """The original loop, one blocking query after another, repeated queries included"""
+    all_metrics = {}
+    for category, metric_list in collector.get_odf_metrics_queries().items():
+        category_metrics = {}
+        for metric in metric_list:
+            results = collector.query_prometheus(metric, time_range)
+            if results:
+                category_metrics[metric] = results
+        if category_metrics:
+            all_metrics[category] = category_metrics
+    return all_metrics
+
+
+def run(name: str, args, slow: List[str], time_range: str = None, max_points: int = DEFAULT_MAX_POINTS,
+        fake: FakePrometheus = None, cache: QueryCache = None):
+    owned = fake is None
+    fake = fake or FakePrometheus(args.series, args.latency, slow, args.slow_latency)
+    queries, served = fake.queries, fake.points
+    output_dir = tempfile.mkdtemp(prefix='odf_bench_')
+    try:
+        collector = PrometheusODFCollector(output_dir=output_dir, max_workers=args.max_workers,
+                                           max_points=max_points, cache=cache)
+        collector.prometheus_url = fake.url
+        started = time.perf_counter()
+        # Leaving the per query lines out of the results
+        with contextlib.redirect_stdout(io.StringIO()):
+            if name == 'sequential':
+                metrics = legacy_collect(collector, time_range or args.time_range)
+            else:
+                metrics = collector.collect_metrics(time_range or args.time_range)
+        spent = time.perf_counter() - started
+        if not owned:
+            return layout(metrics), fake.queries - queries, fake.points - served, spent
+        # Read before the output directory holding the results goes away
+        return layout(metrics), fake.queries, fake.connections, spent
+    finally:
+        shutil.rmtree(output_dir)
+        if owned:
+            fake.close()
+
+
+def layout(metrics) -> Dict[str, Dict[str, List[int]]]:
+    """Points of every series of every metric of every category"""
+    return {category: {metric: [len(r.get('values', [])) for r in results]
+                       for metric, results in category_metrics.items()}
+            for category, category_metrics in metrics.items()}
+
+
+def points(metrics: Dict[str, Dict[str, List[int]]]) -> int:
+    return sum(sum(series) for m in metrics.values() for series in m.values())
+
+
+def bench_long_range(args):
+    """--long-range at 30s in one request per query, as before, against sub-range requests"""
+    rows = []
+    # A limit no range reaches keeps every query in a single request
+    for name, max_points in (('single request', sys.maxsize), (f"split at {DEFAULT_MAX_POINTS}", DEFAULT_MAX_POINTS)):
+        metrics, queried, _, spent = run(name, args, [], args.long_range, max_points)
+        rows.append((name, queried, sum(len(m) for m in metrics.values()), points(metrics), spent))
+    print(f"{args.long_range} at 30s, {args.latency * 1000:.0f}ms per request")
+    print(f"{'':<26}{'requests':>9}{'metrics':>9}{'points':>11}{'seconds':>10}")
+    for name, queried, found, total, spent in rows:
+        print(f"{name:<26}{queried:>9}{found:>9}{total:>11}{spent:>10.2f}")
+
+
+def bench_cache(args):
+    """--cache-range without a cache, then twice with one, as when rerunning for other outputs"""
+    fake = FakePrometheus(args.series, args.latency)
+    cache_dir = tempfile.mkdtemp(prefix='odf_bench_cache_')
+    try:
+        rows = []
+        outputs = []
+        for name, cached in (('no cache', False), ('first run, cold cache', True), ('rerun, warm cache', True)):
+            cache = QueryCache(cache_dir) if cached else None
+            metrics, queried, served, spent = run(name, args, [], args.cache_range, fake=fake, cache=cache)
+            outputs.append(metrics)
+            rows.append((name, queried, served, spent))
+    finally:
+        shutil.rmtree(cache_dir)
+        fake.close()
+    print(f"{args.cache_range} at 30s, {args.latency * 1000:.0f}ms per request")
+    print(f"{'':<26}{'requests':>9}{'points served':>15}{'seconds':>10}")
+    for name, queried, served, spent in rows:
+        print(f"{name:<26}{queried:>9}{served:>15}{spent:>10.2f}")
+    print(f"Same series and points: {'yes' if all(o == outputs[0] for o in outputs) else 'NO'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='collect_odf_metrics.py benchmark')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds per query (default: 0.05)')
+    parser.add_argument('--slow', type=int, default=3, help='Queries answering slowly (default: 3)')
+    parser.add_argument('--slow-latency', type=float, default=1.0,
+                        help='Seconds per slow query (default: 1.0)')
+    parser.add_argument('--series', type=int, default=4, help='Series per query (default: 4)')
+    parser.add_argument('--time-range', default='1h', help='Time range of the queries (default: 1h)')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS,
+                        help=f'Collector workers (default: {DEFAULT_MAX_WORKERS})')
+    parser.add_argument('--long-range', default='7d',
+                        help='Time range of the sub-range benchmark, none to skip it (default: 7d)')
+    parser.add_argument('--cache-range', default='1d',
+                        help='Time range of the query cache benchmark, none to skip it (default: 1d)')
+    args = parser.parse_args()
+
+    queries = PrometheusODFCollector.get_odf_metrics_queries(None)
+    unique = list(dict.fromkeys(q for metric_list in queries.values() for q in metric_list))
+    # Spread the slow ones over the categories
+    slow = unique[::max(1, len(unique) // args.slow)][:args.slow] if args.slow else []
+
+    rows = []
+    outputs = []
+    for name in ('sequential', f"concurrent, {args.max_workers} workers"):
+        metrics, queried, connections, spent = run(name, args, slow)
+        outputs.append(metrics)
+        rows.append((name, queried, connections, spent))
+
+    print(f"{sum(len(m) for m in queries.values())} queries ({len(unique)} distinct), "
+          f"{args.latency * 1000:.0f}ms each, {len(slow)} of them {args.slow_latency * 1000:.0f}ms")
+    print(f"{'':<26}{'queries':>9}{'connections':>13}{'seconds':>10}")
+    for name, queried, connections, spent in rows:
+        print(f"{name:<26}{queried:>9}{connections:>13}{spent:>10.2f}")
+    # Timestamps differ between the runs, the layout must not
+    same = all(output == outputs[0] for output in outputs)
+    print(f"Same categories, queries and series: {'yes' if same else 'NO'}")
+    if args.long_range != 'none':
+        print('')
+        bench_long_range(args)
+    if args.cache_range != 'none':
+        print('')
+        bench_cache(args)
+
+
+if __name__ == '__main__':
+    main()
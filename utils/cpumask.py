@@ -1,68 +1,227 @@
 #!/usr/bin/env python3
 import sys
 import re
+import os
+import json
+import argparse
+import functools
 
-def list_to_mask(cpu_range_str):
-    """Converts '1-3,288' to kernel hex mask."""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def parse_list(cpu_range_str):
+    """Converts '1-3,288' to an int, None if invalid."""
     mask = 0
     try:
         for part in cpu_range_str.split(','):
             if '-' in part:
                 start, end = map(int, part.split('-'))
-                for i in range(start, end + 1):
-                    mask |= (1 << i)
+                if end >= start:
+                    # Whole range in one shift instead of a bit at a time
+                    mask |= ((1 << (end - start + 1)) - 1) << start
             else:
                 mask |= (1 << int(part))
     except ValueError:
         return None
+    return mask
 
-    chunks = []
+def list_to_mask(cpu_range_str):
+    """Converts '1-3,288' to kernel hex mask."""
+    mask = parse_list(cpu_range_str)
+    if mask is None:
+        return None
+    return format_mask(mask)
+
+def format_mask(mask):
+    """Formats an int as comma separated 32-bit hex chunks."""
     # Determine how many 32-bit chunks we need based on the highest bit set
     num_chunks = (mask.bit_length() + 31) // 32
     if num_chunks == 0: num_chunks = 1
-    
-    for i in range(num_chunks):
-        chunk = (mask >> (32 * i)) & 0xffffffff
-        chunks.append(f"{chunk:08x}")
-    
-    chunks.reverse()
-    return ",".join(chunks)
 
-def mask_to_list(hex_mask_str):
-    """Converts 'ff,00000000' to CPU ranges."""
+    digits = f"{mask:0{num_chunks * 8}x}"
+    return ",".join([digits[i:i + 8] for i in range(0, len(digits), 8)])
+
+def parse_mask(hex_mask_str):
+    """Converts 'ff,00000000' to an int, None if invalid."""
     # Clean string: remove 0x and whitespace
     clean_mask = hex_mask_str.replace('0x', '').strip()
     chunks = clean_mask.split(',')
-    
+
     full_mask = 0
     for i, chunk in enumerate(reversed(chunks)):
         try:
             full_mask |= int(chunk, 16) << (32 * i)
         except ValueError:
             return None
-    
-    active_cpus = [i for i in range(full_mask.bit_length()) if (full_mask >> i) & 1]
-    
-    if not active_cpus:
-        return "None"
-
-    ranges = []
-    start = active_cpus[0]
-    for j in range(1, len(active_cpus) + 1):
-        if j == len(active_cpus) or active_cpus[j] != active_cpus[j-1] + 1:
-            end = active_cpus[j-1]
-            ranges.append(f"{start}-{end}" if start != end else str(start))
-            if j < len(active_cpus):
-                start = active_cpus[j]
-    return ",".join(ranges)
+    return full_mask if full_mask >= 0 else None
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: ./cpumask.py <cpu-list (e.g. 0-4,288) OR hex-mask (e.g. ff,0000000f)>")
-        sys.exit(1)
+def mask_runs(mask):
+    """Yields (start, end) of every run of set bits, lowest first."""
+    while mask:
+        start = (mask & -mask).bit_length() - 1
+        shifted = mask >> start
+        # Lowest clear bit of shifted is the length of the run
+        length = (~shifted & (shifted + 1)).bit_length() - 1
+        yield start, start + length - 1
+        mask = (shifted >> length) << (start + length)
 
-    arg = sys.argv[1].strip()
+def format_runs(runs):
+    ranges = [f"{start}-{end}" if start != end else str(start) for start, end in runs]
+    return ",".join(ranges) if ranges else "None"
+
+def mask_to_list(hex_mask_str):
+    """Converts 'ff,00000000' to CPU ranges."""
+    full_mask = parse_mask(hex_mask_str)
+    if full_mask is None:
+        return None
+    return format_runs(mask_runs(full_mask))
+
+class CpuSet:
+    """Set of CPUs backed by an int bitmask.
+
+    Union, intersection, difference and counting work on the int in
+    O(words), the CPU list and hex mask strings are only formatted when
+    asked for, and only once.
+    """
+    __slots__ = ("bits", "_list", "_mask")
+
+    def __init__(self, bits=0):
+        if bits < 0:
+            raise ValueError("CPU bitmask cannot be negative")
+        self.bits = bits
+        self._list = None
+        self._mask = None
+
+    @classmethod
+    def from_list(cls, cpu_range_str):
+        """CpuSet of '1-3,288', raises ValueError if invalid."""
+        bits = parse_list(cpu_range_str)
+        if bits is None:
+            raise ValueError(f"Invalid CPU list: {cpu_range_str}")
+        return cls(bits)
+
+    @classmethod
+    def from_mask(cls, hex_mask_str):
+        """CpuSet of 'ff,00000000', raises ValueError if invalid."""
+        bits = parse_mask(hex_mask_str)
+        if bits is None:
+            raise ValueError(f"Invalid hex mask: {hex_mask_str}")
+        return cls(bits)
+
+    @classmethod
+    def from_cpus(cls, cpus):
+        bits = 0
+        for cpu in cpus:
+            bits |= 1 << cpu
+        return cls(bits)
+
+    def to_list(self):
+        """'0-3,8' style list, "None" when empty like mask_to_list."""
+        if self._list is None:
+            self._list = format_runs(mask_runs(self.bits))
+        return self._list
+
+    def to_mask(self):
+        """Kernel hex mask, e.g. '00000001,0000000f'."""
+        if self._mask is None:
+            self._mask = format_mask(self.bits)
+        return self._mask
+
+    def __or__(self, other):
+        return CpuSet(self.bits | other.bits)
+
+    def __and__(self, other):
+        return CpuSet(self.bits & other.bits)
+
+    def __sub__(self, other):
+        return CpuSet(self.bits & ~other.bits)
+
+    def __xor__(self, other):
+        return CpuSet(self.bits ^ other.bits)
+
+    union = __or__
+    intersection = __and__
+    difference = __sub__
+    symmetric_difference = __xor__
+
+    def isdisjoint(self, other):
+        return not self.bits & other.bits
+
+    def __le__(self, other):
+        return not self.bits & ~other.bits
+
+    def __ge__(self, other):
+        return not other.bits & ~self.bits
+
+    issubset = __le__
+    issuperset = __ge__
+
+    def __eq__(self, other):
+        return isinstance(other, CpuSet) and self.bits == other.bits
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __len__(self):
+        return bin(self.bits).count("1")
+
+    def __contains__(self, cpu):
+        return cpu >= 0 and (self.bits >> cpu) & 1 == 1
+
+    def __iter__(self):
+        for start, end in mask_runs(self.bits):
+            yield from range(start, end + 1)
+
+    def __str__(self):
+        return self.to_list()
+
+    def __repr__(self):
+        return f"CpuSet('{self.to_list()}')"
+
+def lists_to_masks(cpu_range_strs):
+    """Batch list_to_mask, returns a list of masks (None where invalid)."""
+    return [list_to_mask(s) for s in cpu_range_strs]
 
+def masks_to_lists(hex_mask_strs):
+    """Batch mask_to_list, returns a list of CPU ranges (None where invalid).
+
+    With NumPy available and fragmented masks (many runs, e.g. every other
+    SMT sibling) all masks are unpacked into one bit matrix and the run
+    boundaries of every row are found with a single diff, otherwise the run
+    arithmetic of mask_to_list is cheaper.
+    """
+    masks = [parse_mask(s) for s in hex_mask_strs]
+    if numpy is None or len(masks) < 64 or _avg_runs(masks) < 16:
+        return [None if m is None else format_runs(mask_runs(m)) for m in masks]
+
+    width = max(((m or 0).bit_length() + 7) // 8 for m in masks) or 1
+    packed = numpy.frombuffer(b"".join([(m or 0).to_bytes(width, "little") for m in masks]),
+                              dtype=numpy.uint8).reshape(len(masks), width)
+    bits = numpy.unpackbits(packed, axis=1, bitorder="little").astype(numpy.int8)
+    # Padding both ends makes every run start with +1 and end with -1
+    edges = numpy.diff(numpy.pad(bits, ((0, 0), (1, 1))), axis=1)
+    rows, cols = numpy.nonzero(edges)
+    results = ["None"] * len(masks)
+    # Boundaries come out row by row, alternating start and end+1
+    bounds = numpy.split(cols, numpy.searchsorted(rows, numpy.arange(1, len(masks))))
+    for i, row in enumerate(bounds):
+        if masks[i] is None:
+            results[i] = None
+        elif len(row):
+            results[i] = format_runs(zip(row[0::2].tolist(), (row[1::2] - 1).tolist()))
+    return results
+
+def _avg_runs(masks):
+    # Every run has two edges where a bit differs from its neighbour
+    edges = sum(bin(m ^ (m << 1)).count("1") for m in masks if m)
+    return edges / 2 / len(masks)
+
+def is_hex_mask(arg):
     # STRICT DETECTION
     # If it contains '-' it MUST be a CPU list.
     # If it contains 'a-f' or is multiple 8-char hex blocks, it's a mask.
@@ -71,8 +230,232 @@ if __name__ == "__main__":
         is_hex = True
     if '-' in arg: # Hyphens never appear in hex masks
         is_hex = False
+    return is_hex
+
+def convert_batch(args):
+    """Converts many lists and masks at once, keeping their order."""
+    hex_idx = [i for i, arg in enumerate(args) if is_hex_mask(arg)]
+    list_idx = [i for i, arg in enumerate(args) if not is_hex_mask(arg)]
+    results = [None] * len(args)
+    for i, res in zip(hex_idx, masks_to_lists([args[i] for i in hex_idx])):
+        results[i] = res
+    for i, res in zip(list_idx, lists_to_masks([args[i] for i in list_idx])):
+        results[i] = res
+    return results
+
+@functools.lru_cache(maxsize=None)
+def decode_mask(mask_str):
+    """CpuSet of a kernel hex mask, raises ValueError if invalid.
+
+    The same handful of affinity masks is shared by thousands of IRQs and
+    tasks, each distinct one is parsed once and its CpuSet shared.
+    """
+    return CpuSet.from_mask(mask_str)
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _cmdline_cpus(cmdline, param):
+    """CPU list of a kernel parameter, isolcpus flags such as managed_irq dropped."""
+    for arg in cmdline.split():
+        if arg.startswith(param + "="):
+            cpus = [p for p in arg.split("=", 1)[1].split(",") if p[:1].isdigit()]
+            return ",".join(cpus)
+    return None
+
+def isolated_cpus(root="/"):
+    """Returns {source: cpu list} of every place CPUs are isolated from."""
+    sources = {}
+    sysfs = _read(os.path.join(root, "sys/devices/system/cpu/isolated"))
+    if sysfs:
+        sources["sysfs isolated"] = sysfs
+    cgroup = _read(os.path.join(root, "sys/fs/cgroup/cpuset.cpus.isolated"))
+    if cgroup:
+        sources["cpuset isolated"] = cgroup
+    cmdline = _read(os.path.join(root, "proc/cmdline")) or ""
+    for param in ("isolcpus", "nohz_full"):
+        cpus = _cmdline_cpus(cmdline, param)
+        if cpus:
+            sources[param] = cpus
+    return sources
+
+def scan_irqs(root):
+    """Yields (irq, actions, CpuSet) of every IRQ affinity."""
+    irq_dir = os.path.join(root, "proc/irq")
+    try:
+        irqs = sorted((int(n) for n in os.listdir(irq_dir) if n.isdigit()))
+    except OSError:
+        return
+    for irq in irqs:
+        path = os.path.join(irq_dir, str(irq))
+        # effective_affinity is where the IRQ really fires when the chip has it
+        mask_str = _read(os.path.join(path, "effective_affinity")) or \
+            _read(os.path.join(path, "smp_affinity"))
+        if not mask_str:
+            continue
+        try:
+            cpus = decode_mask(mask_str)
+        except ValueError:
+            continue
+        try:
+            actions = ",".join(sorted(n for n in os.listdir(path)
+                                      if os.path.isdir(os.path.join(path, n))))
+        except OSError:
+            actions = ""
+        yield irq, actions, cpus
+
+def scan_tasks(root):
+    """Yields (pid, tid, name, CpuSet) of every thread."""
+    proc = os.path.join(root, "proc")
+    for pid in os.listdir(proc):
+        if not pid.isdigit():
+            continue
+        task_dir = f"{proc}/{pid}/task/"
+        try:
+            tids = os.listdir(task_dir)
+        except OSError:
+            continue  # Exited while scanning
+        for tid in tids:
+            status = _read(f"{task_dir}{tid}/status")
+            if not status:
+                continue
+            # Looking the two fields up instead of walking the ~60 lines
+            name = None
+            if status.startswith("Name:"):
+                name = status[5:status.find("\n")].strip()
+            start = status.find("\nCpus_allowed:")
+            if start < 0:
+                continue
+            end = status.find("\n", start + 14)
+            mask_str = status[start + 14:end if end >= 0 else None].strip()
+            if mask_str:
+                try:
+                    yield int(pid), int(tid), name, decode_mask(mask_str)
+                except ValueError:
+                    continue
+
+def audit(root="/"):
+    """Scans IRQs and tasks of the host under root against its isolated CPUs."""
+    sources = isolated_cpus(root)
+    isolated = CpuSet()
+    for cpus in sources.values():
+        try:
+            isolated |= CpuSet.from_list(cpus)
+        except ValueError:
+            print(f"Warning: ignoring invalid CPU list {cpus}", file=sys.stderr)
+    report = {"isolated": isolated.to_list(), "sources": sources,
+              "default_smp_affinity": None, "irqs": [], "irqs_scanned": 0,
+              "floating_tasks": [], "pinned_tasks": 0, "tasks_scanned": 0}
+    if not isolated:
+        return report
+
+    default = _read(os.path.join(root, "proc/irq/default_smp_affinity"))
+    if default:
+        try:
+            cpus = decode_mask(default)
+            report["default_smp_affinity"] = {"cpus": str(cpus), "overlap": str(cpus & isolated)}
+        except ValueError:
+            pass
+
+    for irq, actions, cpus in scan_irqs(root):
+        report["irqs_scanned"] += 1
+        if not cpus.isdisjoint(isolated):
+            report["irqs"].append({"irq": irq, "actions": actions, "cpus": str(cpus),
+                                   "overlap": str(cpus & isolated)})
+
+    # decode_mask shares one CpuSet per distinct mask, so is its verdict
+    verdicts = {}
+    for pid, tid, name, cpus in scan_tasks(root):
+        report["tasks_scanned"] += 1
+        verdict = verdicts.get(cpus.bits)
+        if verdict is None:
+            if cpus.isdisjoint(isolated):
+                verdict = verdicts[cpus.bits] = ()
+            elif cpus <= isolated:
+                verdict = verdicts[cpus.bits] = ("pinned",)
+            else:
+                verdict = verdicts[cpus.bits] = ("floating", str(cpus), str(cpus & isolated))
+        if not verdict:
+            continue
+        if verdict[0] == "pinned":
+            report["pinned_tasks"] += 1
+        else:
+            # Allowed on both sides, the scheduler may move it onto isolated CPUs
+            report["floating_tasks"].append({"pid": pid, "tid": tid, "name": name, "cpus": verdict[1],
+                                             "overlap": verdict[2]})
+    report["floating_tasks"].sort(key=lambda t: (t["pid"], t["tid"]))
+    return report
+
+def print_audit(report):
+    if not report["sources"]:
+        print("No isolated CPUs found (isolcpus, nohz_full, sysfs or cpuset), nothing to audit.")
+        return
+    print(f"Isolated CPUs: {report['isolated']}")
+    for source, cpus in report["sources"].items():
+        print(f"  {source}: {cpus}")
+
+    default = report["default_smp_affinity"]
+    if default:
+        state = f"OVERLAP {default['overlap']}" if default["overlap"] != "None" else "OK"
+        print(f"\ndefault_smp_affinity: {default['cpus']} -> {state}")
+
+    print(f"\nIRQs: {report['irqs_scanned']} scanned, {len(report['irqs'])} overlapping isolated CPUs")
+    for irq in report["irqs"]:
+        print(f"  irq {irq['irq']} [{irq['actions']}]: {irq['cpus']} (isolated: {irq['overlap']})")
+
+    print(f"\nTasks: {report['tasks_scanned']} scanned, {len(report['floating_tasks'])} floating onto "
+          f"isolated CPUs, {report['pinned_tasks']} pinned to isolated CPUs")
+    for task in report["floating_tasks"]:
+        print(f"  pid {task['pid']} tid {task['tid']} ({task['name']}): {task['cpus']} "
+              f"(isolated: {task['overlap']})")
+
+def audit_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="cpumask.py audit",
+        description="Report IRQs and tasks whose affinity overlaps isolated CPUs. "
+                    "Exits 1 when overlaps are found.")
+    parser.add_argument("--root", default="/", help="Root holding proc/ and sys/, e.g. a fake tree (default: /)")
+    parser.add_argument("--json", action="store_true", help="Print the report as json")
+    opts = parser.parse_args(argv)
+
+    report = audit(opts.root)
+    if opts.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_audit(report)
+    default = report["default_smp_affinity"]
+    overlaps = report["irqs"] or report["floating_tasks"] or (default and default["overlap"] != "None")
+    sys.exit(1 if overlaps else 0)
+
+def usage():
+    print("Usage: ./cpumask.py <cpu-list (e.g. 0-4,288) OR hex-mask (e.g. ff,0000000f)>")
+    print("       ./cpumask.py --batch [FILE]   (one list or mask per line, stdin by default)")
+    print("       ./cpumask.py audit [--root DIR] [--json]")
+    sys.exit(1)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        usage()
+
+    if sys.argv[1] == "audit":
+        audit_main(sys.argv[2:])
+
+    if sys.argv[1] == "--batch":
+        if len(sys.argv) > 3:
+            usage()
+        src = open(sys.argv[2]) if len(sys.argv) == 3 and sys.argv[2] != "-" else sys.stdin
+        args = [line.strip() for line in src if line.strip()]
+        for result in convert_batch(args):
+            print(result if result else "Error")
+        sys.exit(0)
+
+    arg = sys.argv[1].strip()
 
-    if is_hex:
+    if is_hex_mask(arg):
         result = mask_to_list(arg)
         if result:
             print(f"Decoding Hex Mask -> CPU List:\n{result}")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Benchmark of cpumask.py conversions on many affinities of a large host.
+
+Compares the original per-bit loops with the range-shift conversions and the
+batch API (NumPy backed when installed), checking they all agree.
+
+Usage:
+    cpumask_bench.py [--count 10000] [--cpus 512] [--fragmented]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import cpumask
+
+def legacy_list_to_mask(cpu_range_str):
+    """Original list_to_mask, a bit at a time."""
+    mask = 0
+    try:
+        for part in cpu_range_str.split(','):
+            if '-' in part:
+                start, end = map(int, part.split('-'))
+                for i in range(start, end + 1):
+                    mask |= (1 << i)
+            else:
+                mask |= (1 << int(part))
+    except ValueError:
+        return None
+    chunks = []
+    num_chunks = (mask.bit_length() + 31) // 32
+    if num_chunks == 0: num_chunks = 1
+    for i in range(num_chunks):
+        chunk = (mask >> (32 * i)) & 0xffffffff
+        chunks.append(f"{chunk:08x}")
+    chunks.reverse()
+    return ",".join(chunks)
+
+def legacy_mask_to_list(hex_mask_str):
+    """Original mask_to_list, testing every bit."""
+    clean_mask = hex_mask_str.replace('0x', '').strip()
+    chunks = clean_mask.split(',')
+    full_mask = 0
+    for i, chunk in enumerate(reversed(chunks)):
+        try:
+            full_mask |= int(chunk, 16) << (32 * i)
+        except ValueError:
+            return None
+    active_cpus = [i for i in range(full_mask.bit_length()) if (full_mask >> i) & 1]
+    if not active_cpus:
+        return "None"
+    ranges = []
+    start = active_cpus[0]
+    for j in range(1, len(active_cpus) + 1):
+        if j == len(active_cpus) or active_cpus[j] != active_cpus[j-1] + 1:
+            end = active_cpus[j-1]
+            ranges.append(f"{start}-{end}" if start != end else str(start))
+            if j < len(active_cpus):
+                start = active_cpus[j]
+    return ",".join(ranges)
+
+def random_lists(count, cpus, seed=42):
+    """Housekeeping style lists: a few ranges, some single CPUs, some SMT siblings."""
+    rand = random.Random(seed)
+    lists = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rand.randint(1, 6)):
+            start = rand.randrange(cpus)
+            end = min(cpus - 1, start + rand.choice([0, 1, 3, 15, 63, 255]))
+            parts.append(f"{start}-{end}" if end != start else str(start))
+        lists.append(",".join(parts))
+    return lists
+
+def fragmented_lists(count, cpus, seed=42):
+    """Random bits, so hundreds of short runs per affinity."""
+    rand = random.Random(seed)
+    return [cpumask.format_runs(cpumask.mask_runs(rand.getrandbits(cpus) | 1)) for _ in range(count)]
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=10000, help="Number of affinities (default: 10000)")
+    parser.add_argument("--cpus", type=int, default=512, help="CPUs on the host (default: 512)")
+    parser.add_argument("--fragmented", action="store_true",
+                        help="Random bit masks instead of a few ranges each")
+    opts = parser.parse_args()
+
+    if opts.fragmented:
+        lists = fragmented_lists(opts.count, opts.cpus)
+    else:
+        lists = random_lists(opts.count, opts.cpus)
+    masks = [legacy_list_to_mask(l) for l in lists]
+
+    rows = [
+        ("list->mask legacy", timed(lambda: [legacy_list_to_mask(l) for l in lists])),
+        ("list->mask shift", timed(lambda: [cpumask.list_to_mask(l) for l in lists])),
+        ("list->mask batch", timed(cpumask.lists_to_masks, lists)),
+        ("mask->list legacy", timed(lambda: [legacy_mask_to_list(m) for m in masks])),
+        ("mask->list runs", timed(lambda: [cpumask.mask_to_list(m) for m in masks])),
+        ("mask->list batch", timed(cpumask.masks_to_lists, masks)),
+    ]
+
+    expected = {"list->mask": masks, "mask->list": rows[3][1][1]}
+    print(f"{opts.count} affinities on {opts.cpus} CPUs, NumPy: {'yes' if cpumask.numpy else 'no'}")
+    print(f"{'':<20}{'total ms':>10}{'us/item':>10}{'speedup':>9}  ok")
+    for name, (spent, result) in rows:
+        legacy = rows[0][1][0] if name.startswith("list") else rows[3][1][0]
+        ok = result == expected[name.split(" ")[0]]
+        print(f"{name:<20}{spent * 1e3:>10.1f}{spent / opts.count * 1e6:>10.2f}"
+              f"{legacy / spent:>8.1f}x  {'yes' if ok else 'NO'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# Author:  Marc Methot
+
+"""
+Micro-benchmark of the journal_text_converter field parser.
+
+Generates a synthetic "journalctl --output verbose" journal and times the
+per-line cost of the original re.match/split based filler loop against
+parse_verbose().
+
+Usage:
+    journal_converter_bench.py [--records 1000000] [--keep FILE]
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from journal_text_converter import parse_verbose
+
+FIELDS = ["PRIORITY", "SYSLOG_FACILITY", "_UID", "_GID", "_BOOT_ID", "_MACHINE_ID",
+          "_HOSTNAME", "_TRANSPORT", "_PID", "_COMM", "_EXE", "_CMDLINE",
+          "_SYSTEMD_CGROUP", "_SYSTEMD_UNIT", "_SYSTEMD_SLICE", "MESSAGE"]
+
+
+def generate(path, records):
+    """Writes a synthetic verbose journal, returns its number of lines"""
+    rand = random.Random(42)
+    with open(path, "w") as f:
+        f.write("-- Logs begin at Mon 2020-01-27 10:00:00 EST. --\n")
+        for i in range(records):
+            f.write("Mon 2020-01-27 {:02d}:{:02d}:{:02d}.{:06d} EST "
+                    "[s=4b0c;i={:x};b=9a2f;m={:x};t={:x};x=e1d2]\n".format(
+                        i // 3600 % 24, i // 60 % 60, i % 60, i % 1000000, i, i,
+                        # Same instant as the header, 2020-01-27 00:00:00 EST is 1580101200
+                        (1580101200 + i % 86400) * 1000000 + i % 1000000))
+            for field in FIELDS[:rand.randint(8, len(FIELDS))]:
+                f.write("    {}=value-{}-{}\n".format(field, i, "x" * rand.randint(0, 60)))
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+
+def legacy_filler(lines):
+    """The version 2.0 filler() loop as the baseline, json writing left out"""
+    __day_filter = re.compile("^[A-z]+.*")
+    __field_filter = re.compile(r"^[\ ]+\w")
+    __message = {}
+    count = 0
+    for line in lines:
+        if re.match(__day_filter, line):
+            time = line.split()[2]
+            try:
+                if __message["TIME"] != time:
+                    count += 1
+                    __message = {}
+            except KeyError:
+                    __message = {"DAY" : line.split()[1], "TIME" : time}
+        if re.match(__field_filter, line):
+            __message[line.split("=")[0][4:]] = ''.join(
+                [o for o in line.split("=")[1:]])[:-1]
+    return count + 1
+
+
+def timed(parser, path):
+    started = time.perf_counter()
+    with open(path) as f:
+        result = parser(f)
+    return time.perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=1000000,
+                        help="Number of synthetic journal records (default: 1000000)")
+    parser.add_argument("--keep", default=None,
+                        help="Write the synthetic journal here and keep it")
+    opts = parser.parse_args()
+
+    path = opts.keep or tempfile.mkstemp(suffix=".journal")[1]
+    try:
+        print("Generating {} records in {}".format(opts.records, path))
+        lines = generate(path, opts.records)
+        # Baseline for the file iteration itself, common to both parsers
+        base, _ = timed(lambda f: sum(1 for _ in f), path)
+        legacy, _ = timed(legacy_filler, path)
+        new, records = timed(lambda f: sum(1 for _ in parse_verbose(f)), path)
+    finally:
+        if not opts.keep:
+            os.unlink(path)
+
+    print("{} lines, {} records".format(lines, records))
+    print("{:<16}{:>10}{:>14}".format("", "total s", "ns/line"))
+    for name, spent in (("file read", base), ("legacy filler", legacy),
+                        ("parse_verbose", new)):
+        print("{:<16}{:>10.2f}{:>14.0f}".format(name, spent, spent / lines * 1e9))
+    print("Parsing speedup (read time excluded): {:.2f}x".format(
+        (legacy - base) / max(new - base, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Author:  Marc Methot
+
+"""
+Query the indexed store written by:
+"journal_text_converter.py --format sqlite -o journal.db JOURNAL"
+
+Time ranges and the unit, priority, pid and hostname filters use the store
+indexes, any other field can be matched with --field KEY=VALUE.
+
+Usage:
+    journal_query.py DB [--since T] [--until T] [-u UNIT] [-p PRIORITY]
+                        [--pid PID] [-H HOST] [-F KEY=VALUE ...]
+                        [-n LIMIT] [-o ndjson|short] [--count]
+
+    T is epoch seconds or local "YYYY-MM-DD[ HH:MM:SS[.ffffff]]".
+    -p keeps messages of that priority and more important, like journalctl.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from journal_text_converter import to_usec
+
+
+def parse_time(value):
+    """Epoch seconds or local date/time string to microseconds"""
+    try:
+        return int(float(value) * 1000000)
+    except ValueError:
+        pass
+    day, _, clock = value.strip().partition(" ")
+    try:
+        return to_usec(day, clock or "00:00:00")
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid time: {}".format(value))
+
+
+def parse_field(value):
+    key, eq, wanted = value.partition("=")
+    if not eq or not key:
+        raise argparse.ArgumentTypeError("expected KEY=VALUE, got: {}".format(value))
+    return key, wanted
+
+
+def build_query(opts):
+    """Returns the SQL statement and its parameters for the given filters"""
+    where = []
+    params = []
+    if opts.since is not None:
+        where.append("realtime >= ?")
+        params.append(opts.since)
+    if opts.until is not None:
+        where.append("realtime <= ?")
+        params.append(opts.until)
+    for column, value in (("unit", opts.unit), ("pid", opts.pid), ("hostname", opts.hostname)):
+        if value is not None:
+            where.append("{} = ?".format(column))
+            params.append(value)
+    if opts.priority is not None:
+        where.append("priority <= ?")
+        params.append(opts.priority)
+    for key, value in opts.field:
+        where.append("json_extract(data, ?) = ?")
+        params.extend(['$."{}"'.format(key), value])
+
+    select = "count(*)" if opts.count else "data"
+    sql = "SELECT {} FROM messages".format(select)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if not opts.count:
+        sql += " ORDER BY realtime"
+        if opts.limit:
+            sql += " LIMIT ?"
+            params.append(opts.limit)
+    return sql, params
+
+
+def short(data):
+    """journalctl "short" like one line rendering of a stored message"""
+    msg = json.loads(data)
+    ident = msg.get("SYSLOG_IDENTIFIER") or msg.get("_COMM") or msg.get("_SYSTEMD_UNIT", "")
+    pid = "[{}]".format(msg["_PID"]) if "_PID" in msg else ""
+    if "DAY" in msg:
+        stamp = "{} {}".format(msg["DAY"], msg.get("TIME", ""))
+    else:
+        stamp = msg.get("__REALTIME_TIMESTAMP", "")
+    return "{} {} {}{}: {}".format(stamp, msg.get("_HOSTNAME", ""), ident, pid, msg.get("MESSAGE", ""))
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Query a journal_text_converter sqlite store")
+    parser.add_argument("db", help="Store written with journal_text_converter.py --format sqlite")
+    parser.add_argument("--since", type=parse_time, help="Messages at or after this time")
+    parser.add_argument("--until", type=parse_time, help="Messages at or before this time")
+    parser.add_argument("-u", "--unit", help="_SYSTEMD_UNIT to match")
+    parser.add_argument("-p", "--priority", type=int, help="Maximum PRIORITY, 0 (emerg) to 7 (debug)")
+    parser.add_argument("--pid", type=int, help="_PID to match")
+    parser.add_argument("-H", "--hostname", help="_HOSTNAME to match")
+    parser.add_argument("-F", "--field", type=parse_field, action="append", default=[],
+                        help="Any other KEY=VALUE to match, can be repeated")
+    parser.add_argument("-n", "--limit", type=int, default=0, help="Stop after N messages")
+    parser.add_argument("-o", "--output", choices=["ndjson", "short"], default="ndjson",
+                        help="ndjson (default) or a journalctl short like line per message")
+    parser.add_argument("--count", action="store_true", help="Only print the number of matches")
+    return parser.parse_args(args)
+
+
+if __name__ == "__main__":
+    opts = parse_args()
+    if not os.path.isfile(opts.db):
+        print("ERROR: {} does not exist".format(opts.db), file=sys.stderr)
+        sys.exit(2)
+    db = sqlite3.connect("file:{}?mode=ro".format(opts.db), uri=True)
+    sql, params = build_query(opts)
+    try:
+        for (row,) in db.execute(sql, params):
+            if opts.count:
+                print(row)
+            else:
+                print(short(row) if opts.output == "short" else row)
+    except BrokenPipeError:
+        # Piped into head or less, nothing left to do
+        sys.stderr.close()
+    db.close()
@@ -1,59 +1,538 @@
 #!/usr/bin/python
 # Author:  Marc Methot
-# Version: 2.0
+# Version: 3.0
 
 """
 Script to convert output of command:
 "journalctl --no-pager --all --boot --output verbose"
+or, with --input-format export, of "journalctl --output export"
 
 To json at which point easier to read and search via jq searches.
 This is done simply because sosreports provides it like so.
+
+The conversion is fully streaming: records are written out as soon as they
+are parsed and the output is never seeked, so memory stays flat whatever the
+size of the journal and both input and output can be pipes.
+
+The export format is cheaper to produce and to parse than verbose, prefer it
+when the journal itself is at hand. Both give the exact __REALTIME_TIMESTAMP
+of every record, verbose through the t= of its header cursor.
+
+With --jobs N the input is split at record boundaries (the unindented
+timestamp lines), the chunks are parsed in a pool of N processes and written
+back in their original order, the output is identical to the serial one.
+
+Input compressed with gzip, xz or zstd (the latter needs the zstandard
+module) is decompressed on the fly, the output is compressed the same way
+when OUT ends in .gz, .xz or .zst or when --compress is given. With --batch
+every journal of a directory is converted to OUT (then a directory) by a
+pool of --jobs processes.
+
+Usage:
+    journal_text_converter.py [-o OUT] [--format json|ndjson|sqlite] [--input-format verbose|export]
+                              [--compress gz|xz|zst] [--jobs N] [--stats] [JOURNAL]
+    journal_text_converter.py --batch DIR [-o OUTDIR] [--format ...] [--jobs N] [--stats]
+
+    JOURNAL defaults to stdin ("-"), OUT defaults to ./journal.json ("-" for
+    stdout). The "json" format is the historical {"messages": [...]} document,
+    "ndjson" writes one message per line and "sqlite" writes an indexed store
+    (OUT then defaults to ./journal.db) to be searched with journal_query.py.
 """
 
-import re
+import argparse
+import gzip
+import io
 import json
+import lzma
 import os
-from sys import argv
+import sqlite3
+import struct
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 8 * 1024 * 1024
+MAGIC = {b"\x1f\x8b": "gz", b"\xfd7zXZ\x00": "xz", b"\x28\xb5\x2f\xfd": "zst"}
+EXTENSIONS = {"json": ".json", "ndjson": ".ndjson", "sqlite": ".db"}
+
+
+def _need_zstandard():
+    if zstandard is None:
+        raise RuntimeError("zstd support needs the zstandard module: pip install zstandard")
+
+
+def open_input(path, binary=False):
+    """Opens a journal, or stdin for "-", transparently decompressing gzip,
+    xz and zstd based on the magic bytes"""
+    if path == "-":
+        src = sys.stdin.buffer
+        head = src.peek(6)
+    else:
+        src = path
+        with open(path, "rb") as f:
+            head = f.read(6)
+    kind = next((k for m, k in MAGIC.items() if head.startswith(m)), None)
+    if kind == "gz":
+        stream = gzip.open(src, "rb")
+    elif kind == "xz":
+        stream = lzma.open(src, "rb")
+    elif kind == "zst":
+        _need_zstandard()
+        raw = src if path == "-" else open(path, "rb")
+        stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw))
+    else:
+        stream = src if path == "-" else open(path, "rb")
+    if binary:
+        return stream
+    # Binary bytes that are not utf-8 are kept as \\xNN escapes
+    return io.TextIOWrapper(stream, encoding="utf-8", errors="backslashreplace")
+
+
+def open_output(path, compress=None):
+    """Opens the text output, or stdout for "-", compressing it if asked or
+    if the file name ends with .gz, .xz or .zst"""
+    if compress is None and path != "-":
+        compress = next((k for k in MAGIC.values() if path.endswith("." + k)), None)
+    if compress is None:
+        return sys.stdout if path == "-" else open(path, "w")
+    dst = sys.stdout.buffer if path == "-" else path
+    if compress == "gz":
+        stream = gzip.open(dst, "wb", compresslevel=6)
+    elif compress == "xz":
+        stream = lzma.open(dst, "wb")
+    else:
+        _need_zstandard()
+        raw = dst if path == "-" else open(path, "wb")
+        stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=path != "-")
+    return io.TextIOWrapper(stream, encoding="utf-8")
+
+
+def parse_verbose(lines):
+    """Yields one dict per journal record found in verbose output lines
+
+    Fields look like "    KEY=value", a value spanning several lines (or
+    binary data printed because of --all) has its continuation lines indented
+    to line up with the start of the value, those are joined back with "\\n".
+    The header cursor "[s=...;t=<hex usec>;...]" gives __REALTIME_TIMESTAMP.
+    """
+    message = None
+    key = None
+    prefix = 0
+    for line in lines:
+        first = line[:1]
+        if "A" <= first <= "z":
+            header = line.split(None, 3)
+            if len(header) < 3:
+                continue
+            if message is not None:
+                yield message
+            message = {"DAY": header[1], "TIME": header[2]}
+            t = header[3].find(";t=") if len(header) > 3 else -1
+            if t != -1:
+                try:
+                    message["__REALTIME_TIMESTAMP"] = str(int(
+                        header[3][t + 3:].split(";", 1)[0].rstrip("]\n"), 16))
+                except ValueError:
+                    pass
+            key = None
+        elif first != " " or message is None:
+            continue
+        elif line[4:5] not in " \n":
+            eq = line.find("=", 4)
+            if eq == -1:
+                continue
+            key = line[4:eq]
+            prefix = eq + 1
+            message[key] = line[prefix:-1] if line[-1] == "\n" else line[prefix:]
+        elif key is not None:
+            message[key] += "\n" + (line[prefix:-1] if line[-1] == "\n" else line[prefix:])
+    if message is not None:
+        yield message
+
+
+def parse_export(journal):
+    """Yields one dict per record of "journalctl --output export" data
+
+    journal is a binary stream. Text fields are "KEY=value\\n", binary ones
+    are "KEY\\n" followed by the little endian 64 bit size of the data, the
+    data itself and a "\\n". Records are separated by an empty line.
+    """
+    readline = journal.readline
+    read = journal.read
+    message = {}
+    while True:
+        line = readline()
+        if not line:
+            break
+        if line == b"\n":
+            if message:
+                yield message
+                message = {}
+            continue
+        if line[-1:] == b"\n":
+            line = line[:-1]
+        eq = line.find(b"=")
+        if eq != -1:
+            message[line[:eq].decode()] = line[eq + 1:].decode("utf-8", "backslashreplace")
+            continue
+        size = read(8)
+        if len(size) != 8:
+            break
+        message[line.decode()] = read(struct.unpack("<Q", size)[0]).decode(
+            "utf-8", "backslashreplace")
+        read(1)
+    if message:
+        yield message
+
+
+class counting_reader():
+    """Binary stream wrapper keeping track of how much was read"""
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+    def readline(self):
+        data = self.stream.readline()
+        self.count += len(data)
+        return data
+    def read(self, size):
+        data = self.stream.read(size)
+        self.count += len(data)
+        return data
+    def close(self):
+        self.stream.close()
+
+
+def split_records(journal, chunk_size=CHUNK_SIZE):
+    """Reads the journal in blocks of about chunk_size, each cut right before
+    a record header so that no record spans two blocks"""
+    carry = ""
+    while True:
+        data = journal.read(chunk_size)
+        if not data:
+            break
+        data = carry + data
+        cut = data.rfind("\n")
+        while cut != -1 and not (cut + 1 < len(data) and "A" <= data[cut + 1] <= "z"):
+            cut = data.rfind("\n", 0, cut)
+        if cut == -1:
+            # No header in there yet, one record bigger than a block
+            carry = data
+            continue
+        carry = data[cut + 1:]
+        yield data[:cut + 1]
+    if carry:
+        yield carry
+
+
+def convert_block(block, fmt):
+    """Worker side of --jobs, parses one block and renders it"""
+    # Lines end at "\n" only, as when iterating the input: splitlines() would
+    # also break on \x0b, \x0c, \x1c-\x1e, \x85... printed raw by --all
+    msgs = list(parse_verbose(io.StringIO(block)))
+    return WRITERS[fmt].render(msgs, fmt), len(msgs)
+
+
+def to_usec(day, clock="00:00:00"):
+    """Local "YYYY-MM-DD" and "HH:MM:SS[.ffffff]" to microseconds since epoch"""
+    stamp = datetime.fromisoformat("{}T{}".format(day, clock))
+    return int(stamp.timestamp()) * 1000000 + stamp.microsecond
+
+
+def realtime_usec(msg):
+    """Record time in microseconds, exact from export input or the verbose
+    header cursor, from DAY/TIME (local time, the verbose header timezone is
+    not kept) when the cursor has no t="""
+    try:
+        return int(msg["__REALTIME_TIMESTAMP"])
+    except (KeyError, ValueError):
+        pass
+    try:
+        return to_usec(msg["DAY"], msg["TIME"])
+    except (KeyError, ValueError):
+        return None
+
+
+class json_writer():
+    """Writes messages as they come in, without ever seeking the output"""
+    def __init__(self, out, fmt="json"):
+        if fmt not in ("json", "ndjson"):
+            raise ValueError("Unknown output format: {}".format(fmt))
+        self.out = out
+        self.fmt = fmt
+        self.count = 0
+    def start(self):
+        if self.fmt == "json":
+            self.out.write('{"messages": [\n')
+    def write(self, msg):
+        if self.fmt == "ndjson":
+            self.out.write(json.dumps(msg))
+            self.out.write("\n")
+        else:
+            if self.count:
+                self.out.write(",\n")
+            self.out.write(json.dumps(msg))
+        self.count += 1
+    @staticmethod
+    def render(msgs, fmt):
+        """Serializes msgs exactly as consecutive write() calls would"""
+        if fmt == "ndjson":
+            return "".join([json.dumps(m) + "\n" for m in msgs])
+        return ",\n".join([json.dumps(m) for m in msgs])
+    def write_block(self, block, count):
+        if not count:
+            return
+        if self.fmt == "json" and self.count:
+            self.out.write(",\n")
+        self.out.write(block)
+        self.count += count
+    def end(self):
+        if self.fmt == "json":
+            self.out.write("]}\n")
+        self.out.flush()
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class sqlite_writer():
+    """Writes messages to an SQLite store indexed on the usual search keys,
+    the whole message is kept as json in the data column"""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            realtime INTEGER,
+            unit TEXT,
+            priority INTEGER,
+            pid INTEGER,
+            hostname TEXT,
+            data TEXT NOT NULL
+        )"""
+    INDEXES = {
+        "messages_realtime": "realtime",
+        "messages_unit": "unit, realtime",
+        "messages_priority": "priority, realtime",
+        "messages_pid": "pid, realtime",
+        "messages_hostname": "hostname, realtime",
+    }
+    BATCH = 10000
+    def __init__(self, path, fmt="sqlite"):
+        # Same as the json output, a conversion starts from a clean slate
+        if os.path.exists(path):
+            os.unlink(path)
+        self.db = sqlite3.connect(path)
+        self.fmt = fmt
+        self.count = 0
+        self.rows = []
+    def start(self):
+        # Bulk load, the store can simply be regenerated if this gets interrupted
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute(self.SCHEMA)
+    @staticmethod
+    def render(msgs, fmt="sqlite"):
+        return [(realtime_usec(m), m.get("_SYSTEMD_UNIT"), _int_or_none(m.get("PRIORITY")),
+                 _int_or_none(m.get("_PID")), m.get("_HOSTNAME"), json.dumps(m))
+                for m in msgs]
+    def write(self, msg):
+        self.rows.extend(self.render([msg]))
+        self.count += 1
+        if len(self.rows) >= self.BATCH:
+            self.flush()
+    def write_block(self, block, count):
+        self.rows.extend(block)
+        self.count += count
+        if len(self.rows) >= self.BATCH:
+            self.flush()
+    def flush(self):
+        self.db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", self.rows)
+        self.rows = []
+    def end(self):
+        self.flush()
+        # Indexes are cheaper to build once than to maintain during the load
+        for name, columns in self.INDEXES.items():
+            self.db.execute("CREATE INDEX IF NOT EXISTS {} ON messages ({})".format(name, columns))
+        self.db.commit()
+        self.db.close()
+
+
+WRITERS = {"json": json_writer, "ndjson": json_writer, "sqlite": sqlite_writer}
+
 
 class journal_json():
-    def __init__(self, journal, json_out="./journal.json"):
+    def __init__(self, journal="-", json_out="./journal.json", fmt="json", jobs=1,
+                 input_format="verbose", compress=None):
         self.json_out = json_out
-        self.journal = open(journal, "r")
-        self.json_file = open(self.json_out, "w")
+        self.fmt = fmt
+        self.jobs = jobs
+        self.input_format = input_format
+        if input_format == "export":
+            self.journal = counting_reader(open_input(journal, binary=True))
+        else:
+            self.journal = open_input(journal)
+        if fmt == "sqlite":
+            self.json_file = None
+            self.writer = sqlite_writer(json_out)
+        else:
+            self.json_file = open_output(json_out, compress)
+            self.writer = json_writer(self.json_file, fmt)
+        self.bytes_read = 0
+        self.elapsed = 0.0
     def run(self):
+        started = time.time()
         self.start()
         self.filler()
         self.end()
+        self.elapsed = time.time() - started
     def start(self):
-        self.json_file.write('{"messages": [\n')
+        self.writer.start()
     def end(self):
-        self.json_file.seek(-2, os.SEEK_END)
-        self.json_file.truncate()
-        self.json_file.write("]}")
-        self.journal.close()
-        self.json_file.close()
+        self.writer.end()
+        if self.journal is not sys.stdin:
+            self.journal.close()
+        if self.json_file is not None:
+            if self.json_file is sys.stdout:
+                self.json_file.flush()
+            else:
+                self.json_file.close()
     def filler(self):
-        __day_filter = re.compile("^[A-z]+.*")
-        __field_filter = re.compile("^[\ ]+\w")
-        __message = {}
-        for line in self.journal:
-            if re.match(__day_filter, line):
-                time = line.split()[2]
-                try:
-                    if __message["TIME"] != time:
-                        self.to_json(__message)
-                        __message = {}
-                except KeyError:
-                        __message = {"DAY" : line.split()[1], "TIME" : time}
-            if re.match(__field_filter, line):
-                __message[line.split("=")[0][4:]] = ''.join(
-                    [o for o in line.split("=")[1:]])[:-1]
-        self.to_json(__message)
+        if self.input_format == "export":
+            # Length prefixed binary fields make blind splitting unsafe and
+            # the format is cheap enough to parse serially
+            for msg in parse_export(self.journal):
+                self.to_json(msg)
+            self.bytes_read = self.journal.count
+            return
+        if self.jobs > 1:
+            return self.parallel_filler()
+        for msg in parse_verbose(self.__counted(self.journal)):
+            self.to_json(msg)
+    def parallel_filler(self):
+        # Only a couple of blocks per worker are in flight, keeps memory bounded
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.jobs) as pool:
+            for block in split_records(self.journal):
+                self.bytes_read += len(block)
+                pending.append(pool.submit(convert_block, block, self.fmt))
+                if len(pending) >= self.jobs * 2:
+                    self.writer.write_block(*pending.popleft().result())
+            while pending:
+                self.writer.write_block(*pending.popleft().result())
     def to_json(self, msg):
-        __j_obj = json.dumps(msg)
-        self.json_file.write(__j_obj)
-        self.json_file.write(",\n")
+        self.writer.write(msg)
+    def __counted(self, lines):
+        for line in lines:
+            self.bytes_read += len(line)
+            yield line
+    def stats(self):
+        """Returns a one line throughput summary of the last run"""
+        elapsed = self.elapsed or 1e-9
+        mb = self.bytes_read / (1024 * 1024)
+        return "{} records, {:.1f} MB in {:.2f}s: {:.1f} MB/s, {:.0f} records/s".format(
+            self.writer.count, mb, elapsed, mb / elapsed, self.writer.count / elapsed)
 
-if __name__ == "__main__":
-    j_file = journal_json(argv[1])
+
+def _convert_file(journal, json_out, fmt, input_format, compress):
+    """Worker side of --batch, one whole journal per process"""
+    j_file = journal_json(journal, json_out, fmt, 1, input_format, compress)
     j_file.run()
+    return j_file.stats()
+
+
+def batch_convert(directory, out_dir, fmt="json", input_format="verbose", compress=None, jobs=1):
+    """Converts every journal found in directory into out_dir with a pool of
+    jobs processes, returns the number of journals that failed"""
+    os.makedirs(out_dir, exist_ok=True)
+    failed = 0
+    taken = set()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {}
+        for name in sorted(os.listdir(directory)):
+            journal = os.path.join(directory, name)
+            if name.startswith(".") or not os.path.isfile(journal):
+                continue
+            base = name
+            for kind in MAGIC.values():
+                if base.endswith("." + kind):
+                    base = base[:-len(kind) - 1]
+            if base in taken:
+                # Same journal compressed two ways, keep them apart
+                base = name
+            taken.add(base)
+            json_out = os.path.join(out_dir, base + EXTENSIONS[fmt])
+            if compress:
+                json_out += "." + compress
+            futures[pool.submit(_convert_file, journal, json_out, fmt, input_format, compress)] = name
+        for future in as_completed(futures):
+            try:
+                print("{}: {}".format(futures[future], future.result()), file=sys.stderr)
+            except Exception as e:
+                print("ERROR: {}: {}".format(futures[future], e), file=sys.stderr)
+                failed += 1
+    return failed
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Convert "journalctl --output verbose" text to json')
+    parser.add_argument('journal', nargs='?', default='-',
+                        help='Verbose journal file to read (default: stdin)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Output file, "-" for stdout (default: ./journal.json, '
+                             './journal.db for sqlite), output directory with --batch')
+    parser.add_argument('--input-format', choices=['verbose', 'export'], default='verbose',
+                        help='Journal given as "--output verbose" (default) or "--output export"')
+    parser.add_argument('--format', choices=['json', 'ndjson', 'sqlite'], default='json',
+                        help='json: {"messages": [...]}, ndjson: one message per line, '
+                             'sqlite: indexed store for journal_query.py')
+    parser.add_argument('--compress', choices=['gz', 'xz', 'zst'], default=None,
+                        help='Compress the output (default: from the output file extension)')
+    parser.add_argument('--batch', metavar='DIR', default=None,
+                        help='Convert every journal in DIR, one output file each')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Parse verbose input with N processes, or convert N journals '
+                             'at once with --batch (default: 1, serial)')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print throughput (MB/s, records/s) to stderr when done')
+    opts = parser.parse_args(args)
+    if opts.compress and opts.format == 'sqlite':
+        parser.error('--compress does not apply to sqlite output')
+    if opts.batch:
+        if not os.path.isdir(opts.batch):
+            parser.error('"{}" is not a directory'.format(opts.batch))
+        opts.output = opts.output or '.'
+    elif opts.output is None:
+        opts.output = './journal.db' if opts.format == 'sqlite' else './journal.json'
+    elif opts.output == '-' and opts.format == 'sqlite':
+        parser.error('sqlite output needs a file')
+    return opts
+
+
+if __name__ == "__main__":
+    opts = parse_args()
+    try:
+        if opts.batch:
+            sys.exit(1 if batch_convert(opts.batch, opts.output, opts.format, opts.input_format,
+                                        opts.compress, opts.jobs) else 0)
+        j_file = journal_json(opts.journal, opts.output, opts.format, opts.jobs,
+                              opts.input_format, opts.compress)
+        j_file.run()
+    except RuntimeError as e:
+        print("ERROR: {}".format(e), file=sys.stderr)
+        sys.exit(2)
+    except BrokenPipeError:
+        # Piped into head or less, nothing left to do. stdout now goes to
+        # devnull, so flushing it on exit does not fail a second time
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    if opts.stats:
+        print(j_file.stats(), file=sys.stderr)